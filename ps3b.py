@@ -3,9 +3,10 @@
 Simulation of a population of viruses that can multiply, die and mutate over time. At any time interval, a virus has probability of producing its copy with same parameters as its own (resistance to each drug can switch from on to off and vice versa with some probability). This probability is computed from basic reproduction rate of this virus multiplied by percent of population avaliable to create out of maximum mossible population. It wont reproduce at all if it doesnt have resistances to all of the drugs active at that moment in simulation. Each virus at any time can alse die with certain probability. 
 """
 
+import math
 import random
-import pylab
 import string
+from bisect import bisect_right
 #from ps3b_precompiled_311 import *
 
 
@@ -20,47 +21,202 @@ class NoChildException(Exception):
 
 
 
+class Strain(object):
+    """
+    Immutable parameters shared by all virus particles of a strain: birth,
+    clearance and mutation probabilities and the drugs the resistances refer
+    to. Strains are interned, Strain.intern returns the same record for equal
+    parameters, so particles only keep a reference to their strain instead of
+    their own copy of the parameters.
+
+    Strains also keep what reproduction needs precomputed: the cumulative
+    binomial distribution of the number of traits an offspring switches, and
+    a cache of the bitmasks of the lists of active drugs seen so far.
+    """
+    __slots__ = ('maxBirthProb', 'clearProb', 'mutProb', 'drugs', 'drugBits', 'flipCdf', 'activeMasks', 'lastActive')
+
+    _interned = {}
+
+    def __init__(self, maxBirthProb, clearProb, mutProb=0.0, drugs=()):
+        """
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+        clearProb: Maximum clearance probability (a float between 0-1)
+        mutProb: Mutation probability of each resistance trait (a float)
+        drugs: the drug names (strings); resistance to drugs[j] is stored in bit
+        j of a particle's resistance bitmask
+        """
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.drugs = tuple(drugs)
+        self.drugBits = {drug: 1 << bit for bit, drug in enumerate(self.drugs)}
+
+        numDrugs = len(self.drugs)
+        self.flipCdf = []
+        cumulative = 0.0
+        for flips in range(numDrugs + 1):
+            cumulative += math.comb(numDrugs, flips) * mutProb ** flips * (1 - mutProb) ** (numDrugs - flips)
+            self.flipCdf.append(cumulative)
+        self.activeMasks = {}
+        self.lastActive = (None, None)
+
+    @classmethod
+    def intern(cls, maxBirthProb, clearProb, mutProb=0.0, drugs=()):
+        """
+        Returns the shared Strain with these parameters, creating it on first
+        use.
+        """
+        key = (maxBirthProb, clearProb, mutProb, tuple(drugs))
+        strain = cls._interned.get(key)
+        if strain is None:
+            strain = cls._interned[key] = cls(*key)
+        return strain
+
+    def __reduce__(self):
+        # Unpickled strains are interned as well
+        return (Strain.intern, (self.maxBirthProb, self.clearProb, self.mutProb, self.drugs))
+
+    def resistanceBits(self, resistances):
+        """
+        Converts a dictionary {drug name: True/False} into a resistance bitmask.
+        """
+        bits = 0
+        for drug, resistant in resistances.items():
+            if resistant:
+                bits |= self.drugBits[drug]
+        return bits
+
+    def resistanceDict(self, bits):
+        """
+        Converts a resistance bitmask into a dictionary {drug name: True/False}.
+        """
+        return {drug: bits & drugBit != 0 for drug, drugBit in self.drugBits.items()}
+
+    def activeMask(self, activeDrugs):
+        """
+        Returns the bitmask of the drugs in the list activeDrugs, or None if
+        one of them is not a drug of this strain (no particle of the strain is
+        resistant to it). Masks are cached per list of drugs, and the mask of
+        the last tuple passed is returned without hashing it again, which makes
+        repeated calls with the same tuple cost the same for any number of
+        drugs. A list argument is converted to a tuple and hashed on every
+        call, which costs time proportional to its length; callers looking up
+        many masks should convert their list to a tuple once.
+        """
+        lastDrugs, lastMask = self.lastActive
+        if activeDrugs is lastDrugs:
+            return lastMask
+        key = tuple(activeDrugs)
+        if key not in self.activeMasks:
+            mask = 0
+            for drug in key:
+                if drug not in self.drugBits:
+                    mask = None
+                    break
+                mask |= self.drugBits[drug]
+            self.activeMasks[key] = mask
+        # Only tuples are remembered, a list could change before the next call
+        if type(activeDrugs) is tuple:
+            self.lastActive = (activeDrugs, self.activeMasks[key])
+        return self.activeMasks[key]
+
+    def flipMask(self, rng=random):
+        """
+        Draws the resistance traits an offspring switches, each one with
+        probability mutProb: the number of switched traits is drawn from its
+        binomial distribution, then that many distinct traits are picked.
+
+        This draws one uniform for the number of switched traits where the
+        former per-trait loop drew one per drug, so seeded object-engine runs
+        differ from those of earlier versions whenever a strain has two or
+        more drugs, even with mutProb 0, and with one drug when mutProb > 0.
+
+        rng: the source of random numbers (see SimpleVirus.doesClear)
+
+        returns: the bitmask of the switched traits (an integer)
+        """
+        numFlips = bisect_right(self.flipCdf, rng.random())
+        if not numFlips:
+            return 0
+        numDrugs = len(self.drugs)
+        numFlips = min(numFlips, numDrugs)
+
+        # Pick whichever of the switched or kept traits are fewer
+        picks = min(numFlips, numDrugs - numFlips)
+        mask = 0
+        while picks:
+            bit = 1 << int(rng.random() * numDrugs)
+            if not mask & bit:
+                mask |= bit
+                picks -= 1
+        if numFlips > numDrugs - numFlips:
+            mask ^= (1 << numDrugs) - 1
+        return mask
+
+
+
 #
 # PROBLEM 1
 #
 class SimpleVirus(object):
     """
     Representation of a simple virus (does not model drug effects/resistance).
+    The parameters are kept in a shared Strain record.
     """
+    __slots__ = ('strain',)
+
     def __init__(self, maxBirthProb, clearProb):
         """
-        Initialize a SimpleVirus instance, saves all parameters as attributes
-        of the instance.        
+        Initialize a SimpleVirus instance, saves all parameters in the
+        interned Strain of the instance.
         maxBirthProb: Maximum reproduction probability (a float between 0-1)        
         clearProb: Maximum clearance probability (a float between 0-1).
         """
-        self.maxBirthProb = maxBirthProb
-        self.clearProb = clearProb
+        self.strain = Strain.intern(maxBirthProb, clearProb)
+
+    @classmethod
+    def _ofStrain(cls, strain):
+        """
+        Creates an instance of strain without interning the parameters again.
+        """
+        virus = cls.__new__(cls)
+        virus.strain = strain
+        return virus
+
+    @property
+    def maxBirthProb(self):
+        return self.strain.maxBirthProb
+
+    @property
+    def clearProb(self):
+        return self.strain.clearProb
 
     def getMaxBirthProb(self):
         """
         Returns the max birth probability.
         """
-        return self.maxBirthProb
+        return self.strain.maxBirthProb
 
     def getClearProb(self):
         """
         Returns the clear probability.
         """
-        return self.clearProb
+        return self.strain.clearProb
 
-    def doesClear(self):
+    def doesClear(self, rng=random):
         """ Stochastically determines whether this virus particle is cleared from the
         patient's body at a time step. 
+        rng: the source of random numbers (an object with a random() method,
+        the random module by default)
         returns: True with probability self.getClearProb and otherwise returns
         False.
         """
-        if random.random() < self.getClearProb():
+        if rng.random() < self.getClearProb():
             return True
         else:
             return False
 
-    def reproduce(self, popDensity):
+    def reproduce(self, popDensity, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the Patient and
@@ -73,6 +229,8 @@ class SimpleVirus(object):
 
         popDensity: the population density (a float), defined as the current
         virus population divided by the maximum population.         
+
+        rng: the source of random numbers (see doesClear)
         
         returns: a new instance of the SimpleVirus class representing the
         offspring of this virus particle. The child should have the same
@@ -80,8 +238,8 @@ class SimpleVirus(object):
         NoChildException if this virus particle does not reproduce.               
         """
         birthProb = self.getMaxBirthProb() * (1 - popDensity)
-        if random.random() < birthProb:
-            offspring = SimpleVirus(self.getMaxBirthProb(), self.getClearProb())
+        if rng.random() < birthProb:
+            offspring = SimpleVirus._ofStrain(self.strain)
             return offspring
         else:
             raise NoChildException
@@ -94,7 +252,7 @@ class Patient(object):
     and his/her virus populations have no drug resistance.
     """    
 
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes.
@@ -103,9 +261,14 @@ class Patient(object):
         SimpleVirus instances)
 
         maxPop: the maximum virus population for this patient (an integer)
+
+        rng: the source of random numbers of the viruses, an object with a
+        random() method such as ps3b_rng.BlockRandom (the random module if
+        None)
         """
         self.viruses = viruses
         self.maxPop = maxPop
+        self.rng = rng
 
     def getViruses(self):
         """
@@ -124,7 +287,7 @@ class Patient(object):
         Gets the size of the current total virus population. 
         returns: The total virus population (an integer)
         """
-        return len(self.getViruses())     
+        return len(self.viruses)
 
     def update(self):
         """
@@ -144,17 +307,20 @@ class Patient(object):
         returns: The total virus population at the end of the update (an
         integer)
         """
-        for virus in self.getViruses():
-            if virus.doesClear():
-                self.viruses.remove(virus)
+        rng = random if self.rng is None else self.rng
+
+        # Keep the survivors in a single pass, compacting the list in place
+        self.viruses[:] = [virus for virus in self.viruses if not virus.doesClear(rng)]
 
         popDensity = self.getTotalPop() / self.getMaxPop()
 
-        for virus in self.getViruses():
+        offspring = []
+        for virus in self.viruses:
             try:
-                self.viruses.append(virus.reproduce(popDensity))
+                offspring.append(virus.reproduce(popDensity, rng))
             except NoChildException:
                 pass
+        self.viruses.extend(offspring)
         
         return self.getTotalPop()
 
@@ -163,7 +329,7 @@ class Patient(object):
 #
 # PROBLEM 2
 #
-def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials):
+def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials, engine='object', workers=1, seed=None):
     """
     Run the simulation and plot the graph for problem 3 (no drugs are used,
     viruses do not have any drug resistance).    
@@ -176,27 +342,28 @@ def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials
     maxBirthProb: Maximum reproduction probability (a float between 0-1)        
     clearProb: Maximum clearance probability (a float between 0-1)
     numTrials: number of simulation runs to execute (an integer)
+    engine: 'object', 'numpy', 'counts', 'ode' or 'tau', see makePatient
+    workers: number of processes running the trials (None for one per CPU)
+    seed: seed making the trials reproducible, see ps3b_parallel
     """
     timeSteps = 3000
 
-    # For each time step its average population over number of trials
-    sums_of_populations = [0 for i in range(timeSteps)]
-    for trial in range(numTrials):
-        viruses = [SimpleVirus(maxBirthProb, clearProb) for i in range(numViruses)]
-        patient = Patient(viruses, maxPop)
-        for timeStep in range(timeSteps):
-            sums_of_populations[timeStep] += patient.update()
-    popAverage = [popSum / numTrials for popSum in sums_of_populations]
+    if workers != 1 or seed is not None:
+        from ps3b_parallel import parallelSimulationWithoutDrug
+        popAverage = parallelSimulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials, timeSteps,
+                                                   engine, seed, workers)
+    else:
+        # For each time step its average population over number of trials
+        sums_of_populations = [0 for i in range(timeSteps)]
+        for trial in range(numTrials):
+            populations = runTrialWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, timeSteps, engine)
+            for timeStep in range(timeSteps):
+                sums_of_populations[timeStep] += populations[timeStep]
+        popAverage = [popSum / numTrials for popSum in sums_of_populations]
    
     # Plotting
-    pylab.figure('Average population on different times')
-    pylab.plot([i for i in range(timeSteps)], popAverage, label='average population')
-    pylab.title('Average population on different times')
-    pylab.xlabel('time')
-    pylab.ylabel('population')
-    pylab.xlim(0, timeSteps-1)
-    pylab.ylim(0, maxPop)
-    pylab.show()
+    from ps3b_plot import plotSimulationWithoutDrug
+    plotSimulationWithoutDrug(popAverage, maxPop)
 
 
     
@@ -205,8 +372,11 @@ def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials
 #
 class ResistantVirus(SimpleVirus):
     """
-    Representation of a virus which can have drug resistance.
+    Representation of a virus which can have drug resistance. The resistances
+    are stored as an integer bitmask, whose bits follow the drugs of the
+    virus's Strain.
     """   
+    __slots__ = ('resistBits',)
 
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
@@ -226,21 +396,39 @@ class ResistantVirus(SimpleVirus):
         the probability of the offspring acquiring or losing resistance to a drug.
         """
         
-        SimpleVirus.__init__(self, maxBirthProb, clearProb)
-        self.resistances = resistances
-        self.mutProb = mutProb
+        self.strain = Strain.intern(maxBirthProb, clearProb, mutProb, resistances)
+        self.resistBits = self.strain.resistanceBits(resistances)
+
+    @classmethod
+    def _withBits(cls, strain, resistBits):
+        """
+        Creates an instance of strain with the given resistance bitmask.
+        """
+        virus = cls.__new__(cls)
+        virus.strain = strain
+        virus.resistBits = resistBits
+        return virus
+
+    @property
+    def mutProb(self):
+        return self.strain.mutProb
+
+    @property
+    def resistances(self):
+        return self.getResistances()
 
     def getResistances(self):
         """
-        Returns the resistances for this virus.
+        Returns the resistances for this virus (a new dictionary mapping drug
+        names to True or False).
         """
-        return self.resistances
+        return self.strain.resistanceDict(self.resistBits)
 
     def getMutProb(self):
         """
         Returns the mutation probability for this virus.
         """
-        return self.mutProb
+        return self.strain.mutProb
 
     def isResistantTo(self, drug):
         """
@@ -253,9 +441,9 @@ class ResistantVirus(SimpleVirus):
         returns: True if this virus instance is resistant to the drug, False
         otherwise.
         """
-        return self.getResistances().get(drug, False)
+        return self.resistBits & self.strain.drugBits.get(drug, 0) != 0
           
-    def reproduce(self, popDensity, activeDrugs):
+    def reproduce(self, popDensity, activeDrugs, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the TreatedPatient class.
@@ -292,27 +480,38 @@ class ResistantVirus(SimpleVirus):
         virus population divided by the maximum population       
 
         activeDrugs: a list of the drug names acting on this virus particle
-        (a list of strings).
+        (a list of strings). Passing the same tuple on every call makes the
+        resistance check cost the same for any number of drugs, see
+        Strain.activeMask; a list is rehashed on every call.
+
+        rng: the source of random numbers (see SimpleVirus.doesClear)
 
         returns: a new instance of the ResistantVirus class representing the
         offspring of this virus particle. The child should have the same
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.
         """
-        for drug in activeDrugs:
-            if not self.isResistantTo(drug):
-                raise NoChildException 
-            
-        birthProb = self.getMaxBirthProb() * (1 - popDensity)
-        if random.random() > birthProb:
+        strain = self.strain
+        mask = strain.activeMask(activeDrugs)
+        if mask is None or self.resistBits & mask != mask:
+            raise NoChildException
+
+        birthProb = strain.maxBirthProb * (1 - popDensity)
+        if rng.random() > birthProb:
             raise NoChildException
         
-        childResistances = self.getResistances().copy()
-        for resistance in childResistances:
-            if random.random() < self.getMutProb():
-                childResistances[resistance] = not childResistances[resistance]
+        return ResistantVirus._withBits(strain, self.childBits(rng))
 
-        return ResistantVirus(self.getMaxBirthProb(), self.getClearProb(), childResistances, self.getMutProb())
+    def childBits(self, rng=random):
+        """
+        Draws the resistances of an offspring of this virus: each resistance
+        trait is switched with probability mutProb.
+
+        rng: the source of random numbers (see SimpleVirus.doesClear)
+
+        returns: the resistance bitmask of the offspring (an integer)
+        """
+        return self.resistBits ^ self.strain.flipMask(rng)
               
 
 
@@ -320,9 +519,20 @@ class TreatedPatient(Patient):
     """
     Representation of a patient. The patient is able to take drugs and his/her
     virus population can acquire resistance to the drugs he/she takes.
+
+    The patient keeps an index of how many particles there are of each
+    genotype (strain and resistance bitmask), updated on clearance and birth,
+    so that resistant populations are counted without visiting the particles.
+    The virus list should therefore only be changed through update().
+
+    update() also keeps a table of the birth probability of each genotype,
+    which only depends on the population density and the prescriptions, so
+    deciding whether a particle reproduces is a lookup and one comparison.
+    It implements ResistantVirus.reproduce() inline and does not call the
+    particles' reproduce() method.
     """
 
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes. Also initializes the list of drugs being administered
@@ -332,9 +542,78 @@ class TreatedPatient(Patient):
         virus instances)
 
         maxPop: The  maximum virus population for this patient (an integer)
+
+        rng: the source of random numbers, see Patient
         """
-        Patient.__init__(self, viruses, maxPop)
+        Patient.__init__(self, viruses, maxPop, rng)
         self.prescriptions = []
+        self.genotypeCounts = {}
+        for virus in viruses:
+            self._countVirus(virus, 1)
+        self.birthTable = {}
+        self.birthTableKey = None
+
+        # Patient-level drug order of getGenotypeCounts: the drugs of the
+        # strains, in the order they are first seen
+        drugs = {}
+        for strain in dict.fromkeys(strain for strain, resistBits in self.genotypeCounts):
+            for drug in strain.drugs:
+                drugs.setdefault(drug, 1 << len(drugs))
+        self.drugs = tuple(drugs)
+        self.drugBits = drugs
+
+    def _countVirus(self, virus, change):
+        """
+        Adds change (an integer) to the index count of the genotype of virus.
+        """
+        key = (virus.strain, virus.resistBits)
+        count = self.genotypeCounts.get(key, 0) + change
+        if count:
+            self.genotypeCounts[key] = count
+        else:
+            del self.genotypeCounts[key]
+
+    def fork(self):
+        """
+        Returns an independent copy of this patient, for branching a
+        simulation into several scenarios. Virus particles never change once
+        created, so the copy shares them and only the lists are copied. The
+        copy draws from the same rng.
+        """
+        patient = TreatedPatient.__new__(TreatedPatient)
+        patient.viruses = self.viruses[:]
+        patient.maxPop = self.maxPop
+        patient.rng = self.rng
+        patient.prescriptions = self.prescriptions[:]
+        patient.genotypeCounts = dict(self.genotypeCounts)
+        patient.birthTable = {}
+        patient.birthTableKey = None
+        patient.drugs = self.drugs
+        patient.drugBits = self.drugBits
+        return patient
+
+    def _birthProbs(self, popDensity, activeDrugs):
+        """
+        Returns the birth probability of every genotype present, a dictionary
+        mapping (strain, resistance bitmask) onto maxBirthProb * (1 -
+        popDensity), or onto None for genotypes that lack the resistance to
+        one of activeDrugs (a tuple of drug names) and do not reproduce. The
+        table is rebuilt when popDensity or activeDrugs change, otherwise
+        only new genotypes are added.
+        """
+        if (popDensity, activeDrugs) != self.birthTableKey:
+            self.birthTable = {}
+            self.birthTableKey = (popDensity, activeDrugs)
+        table = self.birthTable
+        for key in self.genotypeCounts:
+            if key not in table:
+                strain, resistBits = key
+                mask = strain.activeMask(activeDrugs)
+                if mask is None or resistBits & mask != mask:
+                    table[key] = None
+                else:
+                    table[key] = strain.maxBirthProb * (1 - popDensity)
+        return table
 
     def addPrescription(self, newDrug):
         """
@@ -369,14 +648,54 @@ class TreatedPatient(Patient):
         returns: The population of viruses (an integer) with resistances to all
         drugs in the drugResist list.
         """
+        # One tuple for all genotypes, so each strain hashes it only once
+        drugResist = tuple(drugResist)
         resistPop = 0
-        for virus in self.getViruses():
-            resistPop += 1
-            for drug in drugResist:
-                if not virus.isResistantTo(drug):
-                    resistPop -= 1
-                    break
+        for (strain, resistBits), count in self.genotypeCounts.items():
+            mask = strain.activeMask(drugResist)
+            if mask is not None and resistBits & mask == mask:
+                resistPop += count
         return resistPop
+
+    def getGenotypeCounts(self):
+        """
+        Returns the number of virus particles of each genotype, a dictionary
+        mapping resistance bitmasks onto counts, as the other engines do. Bit j
+        stands for resistance to getDrugs()[j], whatever the order of the
+        drugs of each particle's strain.
+        """
+        genotypes = {}
+        strainBits = {}
+        for (strain, resistBits), count in self.genotypeCounts.items():
+            if strain not in strainBits:
+                # None when the strain's bits already are in the patient order
+                bits = [self.drugBits[drug] for drug in strain.drugs]
+                strainBits[strain] = None if self.drugs[:len(bits)] == strain.drugs else bits
+            bits = strainBits[strain]
+            if bits is not None:
+                resistBits = sum(bit for j, bit in enumerate(bits) if resistBits >> j & 1)
+            genotypes[resistBits] = genotypes.get(resistBits, 0) + count
+        return genotypes
+
+    def getDrugs(self):
+        """
+        Returns the drugs the genotype bitmasks of getGenotypeCounts refer to:
+        the drugs of the strains of the initial viruses, in the order they are
+        first listed (a list of strings).
+        """
+        return list(self.drugs)
+
+    def getResistanceHistogram(self):
+        """
+        Returns the number of virus particles resistant to each drug, a
+        dictionary mapping every drug the viruses carry a resistance trait for
+        onto the number of particles resistant to it.
+        """
+        histogram = {}
+        for (strain, resistBits), count in self.genotypeCounts.items():
+            for drug, drugBit in strain.drugBits.items():
+                histogram[drug] = histogram.get(drug, 0) + (count if resistBits & drugBit else 0)
+        return histogram
              
     def update(self):
         """
@@ -399,68 +718,356 @@ class TreatedPatient(Patient):
         integer)
         """
         
-        # Remove some viruses
-        for virus in self.getViruses()[:]:
-            if virus.doesClear():
-                self.viruses.remove(virus)
+        rng = random if self.rng is None else self.rng
+        self._clearViruses(rng)
+        popDensity = self._popDensity()
+        self._reproduceViruses(popDensity, rng)
+        return self.getTotalPop()
 
-        # Population density
-        popDensity = len(self.getViruses()) / self.getMaxPop()
+    # The phases of update(), separate methods so that subclasses such as
+    # ps3b_profile.ProfiledTreatedPatient can wrap them
 
-        # Reproduce
-        for virus in self.getViruses()[:]:
-            try:
-                offspring = virus.reproduce(popDensity, self.getPrescriptions())
-                self.viruses.append(offspring)
-            except NoChildException:
-                pass
-        
-        return self.getTotalPop()
+    def _clearViruses(self, rng):
+        """
+        Removes the viruses that are cleared in this time step, keeping the
+        survivors in a single pass.
+        """
+        survivors = []
+        for virus in self.viruses:
+            if virus.doesClear(rng):
+                self._countVirus(virus, -1)
+            else:
+                survivors.append(virus)
+        self.viruses[:] = survivors
+
+    def _popDensity(self):
+        """
+        Returns the current population density.
+        """
+        return self.getTotalPop() / self.getMaxPop()
+
+    def _reproduceViruses(self, popDensity, rng):
+        """
+        Adds the offspring of the viruses that reproduce in this time step.
+        Blocked genotypes have no probability and draw no random number, as in
+        ResistantVirus.reproduce(); a negative probability (popDensity above
+        1) still draws one.
+        """
+        birthProbs = self._birthProbs(popDensity, tuple(self.prescriptions))
+        childBits = self._childBits
+        offspring = []
+        for virus in self.viruses:
+            birthProb = birthProbs[virus.strain, virus.resistBits]
+            if birthProb is not None and rng.random() <= birthProb:
+                child = ResistantVirus._withBits(virus.strain, childBits(virus, rng))
+                offspring.append(child)
+                self._countVirus(child, 1)
+        self.viruses.extend(offspring)
+
+    def _childBits(self, virus, rng):
+        """
+        Returns the resistance bitmask of an offspring of virus, see
+        ResistantVirus.childBits.
+        """
+        return virus.childBits(rng)
+
+
+
+def _blockRandom(rng):
+    """
+    Returns the rng of an 'object' engine patient for the rng argument of the
+    factories below.
+    """
+    if rng is None:
+        return None
+    from ps3b_rng import BlockRandom
+    return BlockRandom(rng)
+
+
+def makePatient(numViruses, maxPop, maxBirthProb, clearProb, engine='object', rng=None):
+    """
+    Creates a patient holding numViruses identical SimpleVirus particles.
+
+    engine: 'object' for a Patient with one SimpleVirus instance per particle,
+    'numpy' for the array-backed ArrayPatient from ps3b_vectorized, 'counts'
+    for a drug-free GenotypeCountPatient from ps3b_counts, 'ode' or 'tau' for
+    the approximate ApproximatePatient from ps3b_approx. The approximate
+    engines still step exactly while the population is below 1% of maxPop
+    (at most 1000 particles), see ps3b_approx.
+
+    rng: a numpy Generator or seed; the 'object' engine draws from a
+    ps3b_rng.BlockRandom on it, or from the random module if rng is None
+    """
+    if engine == 'object':
+        viruses = [SimpleVirus(maxBirthProb, clearProb) for i in range(numViruses)]
+        return Patient(viruses, maxPop, _blockRandom(rng))
+    if engine == 'numpy':
+        from ps3b_vectorized import ArrayPatient
+        return ArrayPatient([maxBirthProb] * numViruses, [clearProb] * numViruses, maxPop, rng)
+    if engine == 'counts':
+        from ps3b_counts import GenotypeCountPatient
+        return GenotypeCountPatient(maxBirthProb, clearProb, 0.0, [], {0: numViruses}, maxPop, rng)
+    if engine in ('ode', 'tau'):
+        from ps3b_approx import ApproximatePatient
+        return ApproximatePatient(maxBirthProb, clearProb, 0.0, [], {0: numViruses}, maxPop, rng, engine)
+    raise ValueError(f'Unknown simulation engine: {engine!r}')
+
+
+def makeTreatedPatient(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, engine='object', rng=None):
+    """
+    Creates a treated patient holding startPop identical ResistantVirus
+    particles that are resistant to none of the drugs.
+
+    engine: 'object' for a TreatedPatient with one ResistantVirus instance per
+    particle, 'numpy' for the array-backed ArrayTreatedPatient from
+    ps3b_vectorized, 'counts' for the genotype-bucketed GenotypeCountPatient
+    from ps3b_counts, 'ode' or 'tau' for the approximate ApproximatePatient
+    from ps3b_approx. The approximate engines still step exactly while the
+    population is below 1% of maxPop (at most 1000 particles), see
+    ps3b_approx.
+
+    rng: a numpy Generator or seed; the 'object' engine draws from a
+    ps3b_rng.BlockRandom on it, or from the random module if rng is None
+    """
+    resistances = {drug : False for drug in drugs}
+    if engine == 'object':
+        viruses = [ResistantVirus(maxBirthProb, clearProb, resistances, mutProb) for i in range(startPop)]
+        return TreatedPatient(viruses, maxPop, _blockRandom(rng))
+    if engine == 'numpy':
+        from ps3b_vectorized import ArrayTreatedPatient
+        return ArrayTreatedPatient.fromParameters(startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng)
+    if engine == 'counts':
+        from ps3b_counts import GenotypeCountPatient
+        return GenotypeCountPatient.fromParameters(startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng)
+    if engine in ('ode', 'tau'):
+        from ps3b_approx import ApproximatePatient
+        return ApproximatePatient.fromParameters(startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng,
+                                                 engine)
+    raise ValueError(f'Unknown simulation engine: {engine!r}')
+
+
+def runTrialWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, timeSteps, engine='object', rng=None):
+    """
+    Runs a single trial of the simulation without drugs.
+
+    returns: the total virus population after each time step (a list of
+    timeSteps integers)
+    """
+    patient = makePatient(numViruses, maxPop, maxBirthProb, clearProb, engine, rng)
+    return [patient.update() for timeStep in range(timeSteps)]
+
+
+def prescribe(patient, timelyPrescriptions, timeStep):
+    """
+    Administers to patient the drugs scheduled for timeStep, if any.
+
+    timelyPrescriptions: {timeStep : drug name or list of drug names to add
+    before that time step}
+    """
+    if timeStep in timelyPrescriptions:
+        newDrugs = timelyPrescriptions[timeStep]
+        for drug in [newDrugs] if isinstance(newDrugs, str) else newDrugs:
+            patient.addPrescription(drug)
+
+
+def runTrialWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, timeSteps, engine='object', rng=None):
+    """
+    Runs a single trial of the simulation with drugs.
+
+    timelyPrescriptions: {timeStep : drug name or list of drug names to add
+    before that time step}
+
+    returns: a tuple (total population, resistant population) of lists of
+    timeSteps integers, the resistant population being resistant to all the
+    drugs prescribed at that time step
+    """
+    total_pop = []
+    resist_pop = []
+    for timeStep, totalPop, resistPop in iterTrialWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb,
+                                                           timelyPrescriptions, timeSteps, engine, rng):
+        total_pop.append(totalPop)
+        resist_pop.append(resistPop)
+    return total_pop, resist_pop
+
+
+def iterTrialWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, timeSteps, engine='object', rng=None, stopConditions=(), history=None, genotypes=False):
+    """
+    Runs a single trial of the simulation with drugs, yielding the populations
+    after each time step as soon as it is computed.
+
+    timelyPrescriptions: {timeStep : drug name or list of drug names to add
+    before that time step}
+
+    stopConditions: functions called after every time step with the lists of
+    total and resistant populations of the trial so far; the trial ends early
+    as soon as one of them returns True (see populationExtinct and
+    resistantSteadyState)
+
+    history: number of most recent time steps kept in the lists passed to
+    stopConditions (an integer, at least the window of every condition), or
+    None to keep the whole trial; without stopConditions nothing is kept
+
+    genotypes: whether to also yield the genotype counts of the patient after
+    each time step (see TreatedPatient.getGenotypeCounts)
+
+    yields: (timeStep, total population, resistant population) tuples, the
+    resistant population being resistant to all the drugs prescribed at that
+    time step, with the genotype counts {resistance bitmask : count} as a
+    fourth item if genotypes is True
+    """
+    patient = makeTreatedPatient(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, engine, rng)
+    total_pop = []
+    resist_pop = []
+    for timeStep in range(timeSteps):
+        # Add drugs if its time for them
+        prescribe(patient, timelyPrescriptions, timeStep)
+
+        totalPop = patient.update()
+        resistPop = patient.getResistPop(patient.getPrescriptions())
+        if genotypes:
+            yield timeStep, totalPop, resistPop, patient.getGenotypeCounts()
+        else:
+            yield timeStep, totalPop, resistPop
+
+        if stopConditions:
+            total_pop.append(totalPop)
+            resist_pop.append(resistPop)
+            if history is not None and len(total_pop) > history:
+                del total_pop[0], resist_pop[0]
+            if any(condition(total_pop, resist_pop) for condition in stopConditions):
+                return
+
+
+def runSimulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials, timeSteps=3000, engine='object', workers=1, seed=None):
+    """
+    Headless version of simulationWithoutDrug: runs the trials and returns
+    every trial's population curve without plotting anything.
+
+    workers, seed: see ps3b_parallel.collectTrials
+
+    returns: the total virus population, a numpy array of shape (timeSteps,
+    numTrials)
+    """
+    from ps3b_parallel import collectTrials, trialWithoutDrug
+    trialArgs = (numViruses, maxPop, maxBirthProb, clearProb, timeSteps, engine)
+    totalPop, = collectTrials(trialWithoutDrug, trialArgs, numTrials, seed, workers)
+    return totalPop
+
+
+def runSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100, engine='object', workers=1, seed=None):
+    """
+    Headless version of simulationWithDrug: runs the trials and returns every
+    trial's population curves without plotting anything.
+
+    workers, seed: see ps3b_parallel.collectTrials
+
+    returns: a tuple (total population, resistant population) of numpy arrays
+    of shape (timeSteps, numTrials)
+    """
+    from ps3b_parallel import collectTrials
+    trialArgs = (startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, timeSteps, engine)
+    return collectTrials(runTrialWithDrug, trialArgs, numTrials, seed, workers)
+
+
+def populationExtinct(total_pop, resist_pop):
+    """
+    Stop condition for iterSimulationWithDrug: the virus population died out.
+    """
+    return total_pop[-1] == 0
+
+
+def resistantSteadyState(window=50, tolerance=0.01):
+    """
+    Returns a stop condition for iterSimulationWithDrug that is met once the
+    fraction of resistant viruses has stayed within tolerance (a float between
+    0-1) for the last window time steps (an integer).
+    """
+    def condition(total_pop, resist_pop):
+        if len(total_pop) < window:
+            return False
+        fractions = [resist / total if total else 0.0
+                     for total, resist in zip(total_pop[-window:], resist_pop[-window:])]
+        return max(fractions) - min(fractions) <= tolerance
+    return condition
+
+
+def iterSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100, engine='object', stopConditions=(), perTrial=False, seed=None, history=None):
+    """
+    Streaming version of simulationWithDrug: runs the trials one after another
+    and yields their results while they run, without keeping them in memory.
+
+    stopConditions, history: see iterTrialWithDrug; a trial meeting one of
+    the conditions ends early and the next trial starts. Unless history is
+    given, the populations of the running trial are kept for the conditions.
+
+    perTrial: if False, yield one record per time step; if True, yield one
+    record per finished trial
+
+    seed: entropy of the SeedSequence the trial streams are spawned from, as
+    for ps3b_parallel.runTrials, so that trial i runs as in a seeded
+    runSimulationWithDrug (an integer, or None to draw from the random
+    module)
+
+    yields: dictionaries with the keys 'trial', 'timeStep', 'totalPop' and
+    'resistPop' (integers) per time step, or with the keys 'trial', 'steps'
+    (number of time steps run), 'totalPop' and 'resistPop' (lists of
+    integers) per trial
+    """
+    if seed is not None:
+        import numpy as np
+        from ps3b_parallel import seedTrial
+        seedSequences = np.random.SeedSequence(seed).spawn(numTrials)
+    for trial in range(numTrials):
+        rng = None if seed is None else seedTrial(seedSequences[trial])
+        steps = iterTrialWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions,
+                                  timeSteps, engine, rng, stopConditions, history)
+        if not perTrial:
+            for timeStep, totalPop, resistPop in steps:
+                yield {'trial': trial, 'timeStep': timeStep, 'totalPop': totalPop, 'resistPop': resistPop}
+        else:
+            total_pop = []
+            resist_pop = []
+            for timeStep, totalPop, resistPop in steps:
+                total_pop.append(totalPop)
+                resist_pop.append(resistPop)
+            yield {'trial': trial, 'steps': len(total_pop), 'totalPop': total_pop, 'resistPop': resist_pop}
 
 
 
 #
 # PROBLEM 4
 #
-def simulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100):
+def simulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100, engine='object', workers=1, seed=None):
     
 
     ###### Compute curves for average total population and average virus resistant population
-    
-    total_pop_sums = [0 for i in range(timeSteps)]
-    resist_pop_sums = [0 for i in range(timeSteps)]
-
-    # Run the trials and generate information about total and resistant population over time for each trial
-    for trial in range(numTrials):
-        resistances = {drug : False for drug in drugs}
-        viruses = [ResistantVirus(maxBirthProb, clearProb, resistances, mutProb) for i in range(startPop)]
-        patient = TreatedPatient(viruses, maxPop)
-
-        for timeStep in range(timeSteps):
-            # Add a drug if its time for it
-            if timeStep in timelyPrescriptions:
-                patient.addPrescription(timelyPrescriptions[timeStep])
-
-            total_pop_sums[timeStep] += patient.update()
-            resist_pop_sums[timeStep] += patient.getResistPop(patient.getPrescriptions())
 
-    # Get averages from sums
-    total_pop_averages = [i / numTrials for i in total_pop_sums]
-    resist_pop_averages = [i / numTrials for i in resist_pop_sums]
+    if workers != 1 or seed is not None:
+        # Spread the trials over a process pool, see ps3b_parallel
+        from ps3b_parallel import parallelSimulationWithDrug
+        total_pop_averages, resist_pop_averages = parallelSimulationWithDrug(
+            startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, numTrials, timeSteps,
+            engine, seed, workers)
+    else:
+        total_pop_sums = [0 for i in range(timeSteps)]
+        resist_pop_sums = [0 for i in range(timeSteps)]
+
+        # Run the trials and generate information about total and resistant population over time for each trial
+        for trial in range(numTrials):
+            total_pop, resist_pop = runTrialWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb,
+                                                     timelyPrescriptions, timeSteps, engine)
+            for timeStep in range(timeSteps):
+                total_pop_sums[timeStep] += total_pop[timeStep]
+                resist_pop_sums[timeStep] += resist_pop[timeStep]
+
+        # Get averages from sums
+        total_pop_averages = [i / numTrials for i in total_pop_sums]
+        resist_pop_averages = [i / numTrials for i in resist_pop_sums]
 
 
     ###### Plot the curves
-    pylab.figure('Medicated Simulation')
-    pylab.title('Medicated Simulation')
-    pylab.plot([i for i in range(timeSteps)], total_pop_averages, label = 'All viruses', color='grey')
-    pylab.plot([i for i in range(timeSteps)], resist_pop_averages, label = 'Drug-resistant viruses', color='yellow')
-    pylab.axhline(y=maxPop, label='Max possible population', color='black')
-    for timeStep in timelyPrescriptions:
-        pylab.axvline(x=timeStep,  label=f'"{timelyPrescriptions[timeStep]}" prescribed')
-    pylab.xlabel('Time steps')
-    pylab.ylabel('Average population')
-    pylab.legend()
-    pylab.show()
+    from ps3b_plot import plotSimulationWithDrug
+    plotSimulationWithDrug(total_pop_averages, resist_pop_averages, maxPop, timelyPrescriptions)
 
     
 
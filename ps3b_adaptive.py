@@ -0,0 +1,185 @@
+# Adaptive number of trials for simulationWithDrug
+"""
+Runs trials of simulationWithDrug until the averaged curves are known to a
+requested precision, instead of a fixed numTrials. The per-timestep mean and
+variance of each curve are accumulated with Welford's algorithm as trials
+finish, so memory does not grow with the number of trials; batches of trials
+run on worker processes each return their own running statistics, which are
+merged with the parallel form of the algorithm (Chan et al.).
+
+After every batch the half-width of the confidence interval of the mean is
+computed at each time step; once its largest value over both curves is below
+the tolerance, the run stops.
+"""
+
+import os
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ps3b import runTrialWithDrug
+from ps3b_parallel import runTrial
+
+
+
+class RunningStats(object):
+    """
+    Running per-timestep mean and variance of curves, without keeping the
+    curves.
+    """
+
+    def __init__(self, timeSteps):
+        self.count = 0
+        self.mean = np.zeros(timeSteps)
+        self.m2 = np.zeros(timeSteps)
+
+    def add(self, curve):
+        """
+        Adds a curve (a sequence of timeSteps numbers), Welford's update.
+        """
+        curve = np.asarray(curve, dtype=np.float64)
+        self.count += 1
+        delta = curve - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (curve - self.mean)
+
+    def merge(self, other):
+        """
+        Adds the curves summarized by another RunningStats.
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+
+    def getStd(self):
+        """
+        Returns the per-timestep sample standard deviation (an array).
+        """
+        if self.count < 2:
+            return np.full(len(self.mean), np.inf)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def getHalfWidth(self, confidence=0.95):
+        """
+        Returns the per-timestep half-width of the normal confidence interval
+        of the mean at level confidence (an array).
+        """
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        return z * self.getStd() / np.sqrt(max(self.count, 1))
+
+
+def _statsChunk(trialFunction, trialArgs, seedSequences):
+    """
+    Runs one trial per seed sequence and returns the RunningStats of each
+    curve returned by trialFunction (a list).
+    """
+    stats = None
+    for seedSequence in seedSequences:
+        curves = runTrial(trialFunction, trialArgs, seedSequence)
+        if stats is None:
+            stats = [RunningStats(len(curve)) for curve in curves]
+        for curveStats, curve in zip(stats, curves):
+            curveStats.add(curve)
+    return stats
+
+
+def adaptiveTrials(trialFunction, trialArgs, tolerance, confidence=0.95, minTrials=10, maxTrials=1000, batchSize=10, seed=None, workers=1):
+    """
+    Runs batches of trials until the confidence intervals of the mean curves
+    are narrower than tolerance.
+
+    trialFunction, trialArgs: as for ps3b_parallel.runTrials
+
+    tolerance: largest accepted half-width of the confidence intervals, in
+    the units of the curves (a float)
+
+    confidence: level of the confidence intervals (a float between 0-1)
+
+    minTrials, maxTrials: bounds on the number of trials (integers)
+
+    batchSize: number of trials run between two checks (an integer)
+
+    seed: entropy of the SeedSequence the trial streams are spawned from; for
+    a given seed the trials do not depend on workers (the statistics only up
+    to rounding)
+
+    workers: number of worker processes (an integer, None for one per CPU);
+    with 1 worker the trials run in this process
+
+    returns: a tuple (list of RunningStats, one per curve, whether the
+    tolerance was reached)
+    """
+    if minTrials < 1 or maxTrials < minTrials:
+        raise ValueError('need 1 <= minTrials <= maxTrials')
+    seedSequence = np.random.SeedSequence(seed)
+    workers = workers or os.cpu_count() or 1
+    executor = None if workers == 1 else ProcessPoolExecutor(workers)
+    stats = None
+    try:
+        while True:
+            numTrials = 0 if stats is None else stats[0].count
+            batch = seedSequence.spawn(min(max(batchSize, minTrials - numTrials), maxTrials - numTrials))
+            if executor is None:
+                results = [_statsChunk(trialFunction, trialArgs, batch)]
+            else:
+                chunkSize = -(-len(batch) // workers)
+                futures = [executor.submit(_statsChunk, trialFunction, trialArgs, batch[i:i + chunkSize])
+                           for i in range(0, len(batch), chunkSize)]
+                results = [future.result() for future in futures]
+
+            # Merge in chunk order, so the result does not depend on timing
+            for chunkStats in results:
+                if stats is None:
+                    stats = chunkStats
+                else:
+                    for curveStats, other in zip(stats, chunkStats):
+                        curveStats.merge(other)
+
+            numTrials = stats[0].count
+            halfWidth = max(curveStats.getHalfWidth(confidence).max() for curveStats in stats)
+            converged = numTrials >= minTrials and halfWidth <= tolerance
+            if converged or numTrials >= maxTrials:
+                return stats, converged
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def adaptiveSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, timeSteps=100, tolerance=None, confidence=0.95, minTrials=10, maxTrials=1000, batchSize=10, engine='object', seed=None, workers=1):
+    """
+    Runs trials of simulationWithDrug until the confidence intervals of the
+    average total and resistant populations are narrower than tolerance at
+    every time step.
+
+    tolerance: largest accepted half-width of the confidence intervals, in
+    particles (a float, 1% of maxPop if None)
+
+    confidence, minTrials, maxTrials, batchSize, seed, workers: see
+    adaptiveTrials
+
+    returns: a dictionary with 'numTrials', 'converged' (whether the
+    tolerance was reached before maxTrials) and, for 'totalPop' and
+    'resistPop', a dictionary of per-timestep arrays 'mean', 'std', 'lower'
+    and 'upper' (the confidence band)
+    """
+    if tolerance is None:
+        tolerance = 0.01 * maxPop
+    trialArgs = (startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, timeSteps, engine)
+    stats, converged = adaptiveTrials(runTrialWithDrug, trialArgs, tolerance, confidence, minTrials, maxTrials,
+                                      batchSize, seed, workers)
+
+    result = {'numTrials': stats[0].count, 'converged': converged}
+    for name, curveStats in zip(('totalPop', 'resistPop'), stats):
+        halfWidth = curveStats.getHalfWidth(confidence)
+        result[name] = {
+            'mean'  : curveStats.mean,
+            'std'   : curveStats.getStd(),
+            'lower' : curveStats.mean - halfWidth,
+            'upper' : curveStats.mean + halfWidth,
+        }
+    return result
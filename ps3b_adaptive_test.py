@@ -0,0 +1,34 @@
+# Checks of the adaptive number of trials, run with pytest
+"""
+Checks of ps3b_adaptive: RunningStats merged from several chunks of curves
+agree with a single pass of Welford's algorithm over all of them, and with
+numpy.
+"""
+
+import numpy as np
+
+from ps3b_adaptive import RunningStats
+
+
+
+def testMergeMatchesSinglePass():
+    rng = np.random.default_rng(0)
+    curves = rng.normal(1000.0, 50.0, size=(23, 40)) * rng.uniform(0.5, 2.0, size=40)
+
+    singlePass = RunningStats(40)
+    for curve in curves:
+        singlePass.add(curve)
+
+    # Uneven chunks, an empty one included
+    merged = RunningStats(40)
+    for start, stop in ((0, 1), (1, 1), (1, 9), (9, 23)):
+        chunk = RunningStats(40)
+        for curve in curves[start:stop]:
+            chunk.add(curve)
+        merged.merge(chunk)
+
+    assert merged.count == singlePass.count == len(curves)
+    assert np.allclose(merged.mean, singlePass.mean, rtol=1e-12)
+    assert np.allclose(merged.getStd(), singlePass.getStd(), rtol=1e-10)
+    assert np.allclose(merged.mean, curves.mean(axis=0), rtol=1e-12)
+    assert np.allclose(merged.getStd(), curves.std(axis=0, ddof=1), rtol=1e-10)
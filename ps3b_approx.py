@@ -0,0 +1,331 @@
+# Approximate solvers for large virus populations
+"""
+Approximations of the simulation for large maxPop, where the noise of the
+per-particle random draws averages out. Both work on the genotype table of
+GenotypeCountPatient and take the same parameters as simulationWithDrug:
+
+- 'ode': the deterministic mean-field dynamics. Each time step every genotype
+  loses clearProb of its particles and, if resistant to all active drugs,
+  gains maxBirthProb * (1 - popDensity) offspring, a fraction mutProb of which
+  flip each resistance trait. Without drugs this is the logistic map of the
+  expected population.
+
+- 'tau': tau-leaping. One leap covers several time steps: the numbers of
+  cleared particles and offspring of each genotype over the whole leap are
+  drawn from Poisson distributions with the per-step rates of the state at
+  the start of the leap, and the offspring mutations from binomials. The
+  length of a leap is chosen so that the expected change of every genotype
+  that reproduces, and its standard deviation, stay below epsilon times its
+  count (the leap condition of Cao, Gillespie and Petzold), the changes of
+  the other genotypes and of the total stay below epsilon times the total,
+  and the frozen rates cannot overshoot the steady state; leaps are capped at
+  maxLeap steps. Near the steady state leaps are long; where the leap
+  condition rejects a leap of two steps, EXACT_STEPS exact steps follow
+  before the next leap is tried. update() still advances one time step: the
+  steps inside a leap move the counts linearly towards the end of the leap.
+  A prescription change ends the current leap.
+
+Whenever the population is below exactBelow particles (by default 1% of
+maxPop, at most 1000), a step uses the exact binomial draws of
+GenotypeCountPatient instead, since small populations are where extinction
+and the emergence of resistance depend on the noise.
+
+Run as a script to print an accuracy report against the exact engine.
+"""
+
+import time
+
+import numpy as np
+
+from ps3b import runSimulationWithDrug
+from ps3b_counts import GenotypeCountPatient, genotypeMask
+
+
+
+METHODS = ('ode', 'tau')
+
+# Exact time steps taken whenever the leap condition rejects a tau leap,
+# before the next leap is tried
+EXACT_STEPS = 10
+
+
+class ApproximatePatient(GenotypeCountPatient):
+    """
+    GenotypeCountPatient updated with the mean-field ('ode') or tau-leaping
+    ('tau') approximation while its population is large.
+    """
+
+    def __init__(self, maxBirthProb, clearProb, mutProb, drugs, counts, maxPop, rng=None, method='ode', exactBelow=None, epsilon=0.03, maxLeap=50):
+        """
+        Initialization function, see GenotypeCountPatient.
+
+        method: 'ode' or 'tau'
+
+        exactBelow: population size (an integer) below which time steps are
+        simulated exactly; by default 1% of maxPop, at most 1000 particles,
+        so that small patients are not simulated exactly throughout
+
+        epsilon: largest relative change of a genotype, or of the population,
+        over one tau leap (a float), see the module docstring
+
+        maxLeap: largest number of time steps of one tau leap (an integer)
+        """
+        if method not in METHODS:
+            raise ValueError(f'Unknown approximation method: {method!r}')
+        GenotypeCountPatient.__init__(self, maxBirthProb, clearProb, mutProb, drugs, counts, maxPop, rng)
+        self.method = method
+        self.exactBelow = min(1000, maxPop // 100) if exactBelow is None else exactBelow
+        self.epsilon = epsilon
+        self.maxLeap = maxLeap
+        self.exact = False
+        self.leap = None
+        self.leapStep = 0
+        self.exactSteps = 0
+
+    @classmethod
+    def fromParameters(cls, startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng=None, method='ode', exactBelow=None, epsilon=0.03, maxLeap=50):
+        """
+        Builds an ApproximatePatient holding startPop identical particles, see
+        GenotypeCountPatient.fromParameters.
+        """
+        drugs = list(resistances)
+        counts = {genotypeMask(resistances, drugs): startPop}
+        return cls(maxBirthProb, clearProb, mutProb, drugs, counts, maxPop, rng, method, exactBelow, epsilon, maxLeap)
+
+    @property
+    def countType(self):
+        return np.float64 if self.method == 'ode' and not self.exact else np.int64
+
+    @property
+    def minCount(self):
+        # Drop the vanishing fractions of particles the mean-field mutations
+        # spread over every genotype
+        return 1e-9 if self.method == 'ode' and not self.exact else 0
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, exactly if the population is below exactBelow and with the
+        approximation otherwise.
+
+        returns: The total virus population at the end of the update (an
+        integer, or a float for the 'ode' method)
+        """
+        self.exact = self.getTotalPop() < self.exactBelow
+        if self.exact:
+            self.leap = None
+            self._roundCounts()
+        elif self.method == 'tau':
+            return self._leapStep()
+        return GenotypeCountPatient.update(self)
+
+    def _startLeap(self):
+        """
+        Draws the events of a tau leap from the current state: returns the
+        genotype bitmasks (a list), their counts at the start of the leap and
+        their change over the leap (arrays), and the number of time steps of
+        the leap, or None if the leap condition does not allow two steps.
+        """
+        numGenotypes = len(self.counts)
+        masks = np.fromiter(self.counts.keys(), dtype=np.uint64, count=numGenotypes)
+        counts = np.fromiter(self.counts.values(), dtype=np.int64, count=numGenotypes)
+
+        # Mean events per time step, in the order of GenotypeCountPatient.update()
+        deathRates = counts * self.clearProb
+        survivors = counts - deathRates
+        popDensity = survivors.sum() / self.getMaxPop()
+        birthProb = max(0.0, self.maxBirthProb * (1 - popDensity))
+        active = self._drugMask(self.prescriptions)
+        if active is None:
+            birthRates = np.zeros(numGenotypes)
+        else:
+            active = np.uint64(active)
+            birthRates = np.where(masks & active == active, survivors * birthProb, 0.0)
+
+        # Expected offspring per time step that land in each genotype: the
+        # ones that keep their parent's traits plus the single flips from the
+        # other genotypes (two flips or more are of order mutProb ** 2)
+        numDrugs = len(self.drugs)
+        inflow = birthRates * (1 - self.mutProb) ** numDrugs
+        if self.mutProb > 0 and numDrugs:
+            order = np.argsort(masks)
+            flips = masks[:, None] ^ (np.uint64(1) << np.arange(numDrugs, dtype=np.uint64))
+            where = np.minimum(np.searchsorted(masks[order], flips), numGenotypes - 1)
+            found = masks[order][where] == flips
+            flipRate = self.mutProb * (1 - self.mutProb) ** (numDrugs - 1)
+            np.add.at(inflow, order[where[found]], np.broadcast_to(birthRates[:, None] * flipRate, flips.shape)[found])
+
+        # Leap condition of Cao, Gillespie and Petzold on the genotypes that
+        # reproduce: over the leap, the expected change (drift * steps) of
+        # each and its standard deviation (sqrt(spread * steps)) stay below
+        # epsilon times its count, or one particle. The other genotypes only
+        # lose particles at a rate linear in their count and gain mutants, so
+        # their own noise does not feed back into any rate: their expected
+        # changes are bounded by epsilon times the total population instead,
+        # as is the standard deviation of the total, and the leap stays below
+        # 1 / clearProb so that their clearance cannot overshoot. Bounding
+        # them by their own counts would keep the small pools of mutants from
+        # ever leaping.
+        total = counts.sum()
+        drift = np.abs(inflow - deathRates)
+        spread = inflow + deathRates
+        reproducing = birthRates > 0
+        bound = np.where(reproducing, np.maximum(self.epsilon * counts, 1.0), self.epsilon * total)
+        steps = min(self.maxLeap, 1 / self.clearProb if self.clearProb > 0 else np.inf,
+                    np.min(bound / np.maximum(drift, 1e-300)),
+                    np.min(bound[reproducing] ** 2 / np.maximum(spread[reproducing], 1e-300), initial=np.inf),
+                    (self.epsilon * total) ** 2 / max(spread.sum(), 1e-300))
+        if birthProb > 0:
+            # The rates are frozen over the leap, which is an explicit Euler
+            # step of the drift, so the leap is also kept below
+            # 1 / |d drift / d total|: near the steady state the drift is
+            # close to 0 but a longer explicit step would overshoot it
+            slope = abs(survivors[reproducing].sum() / total * self.maxBirthProb * (1 - 2 * popDensity) - self.clearProb)
+            if slope > 0:
+                steps = min(steps, 1 / slope)
+        steps = int(steps)
+        if steps < 2:
+            return None
+
+        deaths = self.rng.poisson(deathRates * steps)
+        births = self.rng.poisson(birthRates * steps)
+
+        # Split the offspring one resistance trait at a time, see
+        # GenotypeCountPatient.update()
+        childMasks, childCounts = masks, births
+        if self.mutProb > 0:
+            for bit in range(len(self.drugs)):
+                flipped = self.rng.binomial(childCounts, self.mutProb)
+                childMasks = np.concatenate((childMasks, childMasks ^ np.uint64(1 << bit)))
+                childCounts = np.concatenate((childCounts - flipped, flipped))
+                nonEmpty = childCounts > 0
+                childMasks, childCounts = childMasks[nonEmpty], childCounts[nonEmpty]
+
+        allMasks, where = np.unique(np.concatenate((masks, childMasks)), return_inverse=True)
+        start = np.zeros(len(allMasks), dtype=np.int64)
+        start[where[:numGenotypes]] = counts
+        change = np.zeros(len(allMasks), dtype=np.int64)
+        np.add.at(change, where, np.concatenate((-deaths, childCounts)))
+        # Over a leap the offspring are cleared too, so the deaths of a
+        # genotype are not bounded by its count at the start; only its count
+        # at the end is
+        change = np.maximum(change, -start)
+        return allMasks.tolist(), start, change, steps
+
+    def _leapStep(self):
+        """
+        Advances the current tau leap, or a new one, by one time step.
+
+        returns: The total virus population at the end of the step (an
+        integer)
+        """
+        prescriptions = tuple(self.prescriptions)
+        if self.leap is None or self.leapPrescriptions != prescriptions:
+            if self.exactSteps == 0:
+                self.leap = self._startLeap()
+                self.leapPrescriptions = prescriptions
+                self.leapStep = 0
+            if self.leap is None:
+                # The population changes too fast to leap: exact steps, the
+                # next leap is only tried after EXACT_STEPS of them
+                self.exactSteps = (self.exactSteps - 1) % EXACT_STEPS
+                self.exact = True
+                return GenotypeCountPatient.update(self)
+        masks, start, change, steps = self.leap
+        self.leapStep += 1
+        # Integer counts on the line from the start to the end of the leap;
+        # a count stays between its two ends, so it is never negative
+        counts = start + change * self.leapStep // steps
+        self.counts = {mask: count for mask, count in zip(masks, counts.tolist()) if count > 0}
+        if self.leapStep == steps:
+            self.leap = None
+        return self.getTotalPop()
+
+    def _roundCounts(self):
+        """
+        Rounds fractional genotype counts left by the mean-field steps to
+        integers, up with probability equal to the fractional part, so the
+        expected counts are unchanged.
+        """
+        rounded = {}
+        for mask, count in self.counts.items():
+            whole = int(count)
+            if self.rng.random() < count - whole:
+                whole += 1
+            if whole:
+                rounded[mask] = whole
+        self.counts = rounded
+
+    def _draw(self, counts, prob):
+        if self.exact:
+            return self.rng.binomial(counts, prob)
+        return counts * prob
+
+
+
+def accuracyReport(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=20, timeSteps=100, methods=METHODS, reference='counts', seed=0):
+    """
+    Compares the averaged curves of the approximate engines with the exact
+    engine on one set of simulationWithDrug parameters.
+
+    methods: the approximate engines to compare ('ode' and/or 'tau')
+
+    reference: the exact engine to compare with ('counts' or 'object')
+
+    returns: a dictionary mapping each engine name to a dictionary with its
+    run time 'seconds', its 'speedup' over the reference and, for the
+    approximations, the largest and root mean square differences of the
+    average total and resistant populations from the reference, as fractions
+    of maxPop ('totalMaxError', 'totalRmsError', 'resistMaxError',
+    'resistRmsError'). The reference entry also holds 'stdError', the largest
+    standard error of its average total population (as a fraction of maxPop),
+    below which differences are not significant.
+    """
+    def run(engine):
+        start = time.perf_counter()
+        totalPop, resistPop = runSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb,
+                                                    timelyPrescriptions, numTrials, timeSteps, engine, seed=seed)
+        return time.perf_counter() - start, totalPop, resistPop
+
+    refSeconds, refTotal, refResist = run(reference)
+    report = {reference: {
+        'seconds'  : refSeconds,
+        'speedup'  : 1.0,
+        'stdError' : float(np.max(refTotal.std(axis=1) / np.sqrt(numTrials))) / maxPop,
+    }}
+    for method in methods:
+        seconds, totalPop, resistPop = run(method)
+        totalError = np.abs(totalPop.mean(axis=1) - refTotal.mean(axis=1)) / maxPop
+        resistError = np.abs(resistPop.mean(axis=1) - refResist.mean(axis=1)) / maxPop
+        report[method] = {
+            'seconds'        : seconds,
+            'speedup'        : refSeconds / seconds,
+            'totalMaxError'  : float(totalError.max()),
+            'totalRmsError'  : float(np.sqrt(np.mean(totalError ** 2))),
+            'resistMaxError' : float(resistError.max()),
+            'resistRmsError' : float(np.sqrt(np.mean(resistError ** 2))),
+        }
+    return report
+
+
+def formatAccuracyReport(report):
+    """
+    Returns the report of accuracyReport as a printable table.
+    """
+    lines = [f'{"engine":<8}{"seconds":>10}{"speedup":>9}{"total max":>11}{"total rms":>11}{"resist max":>12}{"resist rms":>12}']
+    for engine, entry in report.items():
+        line = f'{engine:<8}{entry["seconds"]:10.3f}{entry["speedup"]:9.1f}'
+        if 'totalMaxError' in entry:
+            line += (f'{entry["totalMaxError"]:11.4f}{entry["totalRmsError"]:11.4f}'
+                     f'{entry["resistMaxError"]:12.4f}{entry["resistRmsError"]:12.4f}')
+        else:
+            line += f'   (standard error {entry["stdError"]:.4f})'
+        lines.append(line)
+    lines.append('errors are fractions of maxPop')
+    return '\n'.join(lines)
+
+
+
+if __name__ == '__main__':
+    print(formatAccuracyReport(accuracyReport(100, 100000, 0.1, 0.05, ['guttagonol', 'srinol'], 0.005,
+                                              {150: 'guttagonol', 300: 'srinol'}, numTrials=20, timeSteps=400)))
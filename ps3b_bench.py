@@ -0,0 +1,339 @@
+# Benchmarks for the virus population simulation
+"""
+Benchmark suite for the simulation hot paths: Patient.update,
+TreatedPatient.update, ResistantVirus.reproduce, TreatedPatient.getResistPop
+and the end-to-end simulationWithDrug trials, over a grid of population sizes,
+drug counts and mutation probabilities. Every case reports steps/sec,
+particles/sec and peak memory, and the results can be saved as JSON and
+compared with the results of another commit:
+
+    python ps3b_bench.py --output new.json --compare old.json
+
+With --scaling the script instead checks that the time of a single update()
+step grows linearly with the size of the virus population.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from ps3b import NoChildException, SimpleVirus, Patient, ResistantVirus, TreatedPatient
+
+
+
+def timeUpdateStep(makePatient, popSize, repeats=3):
+    """
+    Times a single update() step of a patient holding popSize viruses.
+
+    makePatient: function taking a population size and returning a fresh
+    patient with that many viruses
+
+    popSize: number of virus particles in the patient (an integer)
+
+    repeats: number of fresh patients to time, the fastest step is kept
+
+    returns: the wall time of one update() step in seconds (a float)
+    """
+    best = float('inf')
+    for i in range(repeats):
+        patient = makePatient(popSize)
+        start = time.perf_counter()
+        patient.update()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def scalingExponent(sizes, times):
+    """
+    Returns the slope of the least squares line through the points
+    (log(size), log(time)). A slope close to 1 means time grows linearly with
+    the population size, a slope close to 2 means it grows quadratically.
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(t) for t in times]
+    xMean = sum(xs) / len(xs)
+    yMean = sum(ys) / len(ys)
+    covariance = sum((x - xMean) * (y - yMean) for x, y in zip(xs, ys))
+    variance = sum((x - xMean) ** 2 for x in xs)
+    return covariance / variance
+
+
+def benchmarkUpdateScaling(sizes=(1000, 4000, 16000, 64000), maxExponent=1.3):
+    """
+    Times Patient.update() and TreatedPatient.update() for each population
+    size in sizes and prints the time per particle. The population is kept at
+    half of maxPop so that both clearance and reproduction take place.
+
+    maxExponent: largest accepted scaling exponent (see scalingExponent)
+
+    returns: True if both update() methods scale no worse than maxExponent
+    """
+    def treatedPatient(popSize):
+        return makeTreatedPatient(popSize, 2, 0.005)
+
+    linear = True
+    for name, makePatient in [('Patient.update', makeSimplePatient), ('TreatedPatient.update', treatedPatient)]:
+        times = [timeUpdateStep(makePatient, popSize) for popSize in sizes]
+        exponent = scalingExponent(sizes, times)
+        print(name)
+        for popSize, t in zip(sizes, times):
+            print(f'  {popSize:>8} viruses: {t * 1e3:9.2f} ms/step  {t / popSize * 1e9:7.1f} ns/particle')
+        print(f'  scaling exponent: {exponent:.2f}')
+        linear = linear and exponent <= maxExponent
+    return linear
+
+
+
+#
+# Benchmark cases
+#
+def drugNames(numDrugs):
+    """
+    Returns the names of numDrugs drugs.
+    """
+    return [f'drug{i}' for i in range(numDrugs)]
+
+
+def makeSimplePatient(popSize):
+    """
+    Returns a Patient holding popSize SimpleVirus particles at half of maxPop.
+    """
+    viruses = [SimpleVirus(0.1, 0.05) for i in range(popSize)]
+    return Patient(viruses, 2 * popSize)
+
+
+def makeTreatedPatient(popSize, numDrugs, mutProb):
+    """
+    Returns a TreatedPatient holding popSize ResistantVirus particles at half
+    of maxPop, taking the first drug, to which every particle is resistant.
+    """
+    drugs = drugNames(numDrugs)
+    resistances = {drug: drug == drugs[0] for drug in drugs}
+    viruses = [ResistantVirus(0.1, 0.05, resistances, mutProb) for i in range(popSize)]
+    patient = TreatedPatient(viruses, 2 * popSize)
+    patient.addPrescription(drugs[0])
+    return patient
+
+
+def measure(setup, run, repeats, trackMemory):
+    """
+    Calls run(setup()) repeats times and returns the fastest wall time of run
+    in seconds, and the peak traced memory in bytes of one more setup and run
+    (None if trackMemory is False). Memory is measured in a separate pass so
+    that tracing does not slow down the timed runs.
+    """
+    best = float('inf')
+    for i in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+        del state
+
+    peakMemory = None
+    if trackMemory:
+        tracemalloc.start()
+        run(setup())
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peakMemory
+
+
+def benchPatientUpdate(popSize, numDrugs, mutProb, engine):
+    """
+    One Patient.update() step; steps are update() calls.
+    """
+    return lambda: makeSimplePatient(popSize), lambda patient: patient.update(), 1, popSize
+
+
+def benchTreatedPatientUpdate(popSize, numDrugs, mutProb, engine):
+    """
+    One TreatedPatient.update() step; steps are update() calls.
+    """
+    return (lambda: makeTreatedPatient(popSize, numDrugs, mutProb),
+            lambda patient: patient.update(), 1, popSize)
+
+
+def benchReproduce(popSize, numDrugs, mutProb, engine):
+    """
+    ResistantVirus.reproduce() on every particle; a step is one pass over the
+    population.
+    """
+    drugs = drugNames(numDrugs)
+
+    def run(patient):
+        for virus in patient.viruses:
+            try:
+                virus.reproduce(0.5, drugs[:1])
+            except NoChildException:
+                pass
+    return lambda: makeTreatedPatient(popSize, numDrugs, mutProb), run, 1, popSize
+
+
+def benchGetResistPop(popSize, numDrugs, mutProb, engine, calls=100):
+    """
+    TreatedPatient.getResistPop() for every prefix of the drug list; steps
+    are getResistPop calls.
+    """
+    drugs = drugNames(numDrugs)
+
+    def run(patient):
+        for i in range(calls):
+            patient.getResistPop(drugs[:i % numDrugs + 1])
+    return lambda: makeTreatedPatient(popSize, numDrugs, mutProb), run, calls, popSize * calls
+
+
+def benchSimulationWithDrug(popSize, numDrugs, mutProb, engine, timeSteps=20):
+    """
+    One end-to-end trial of simulationWithDrug starting at a tenth of maxPop,
+    the first drug prescribed halfway; steps are time steps, particles are
+    counted at the starting population.
+    """
+    from ps3b_parallel import parallelSimulationWithDrug
+    drugs = drugNames(numDrugs)
+
+    def run(state):
+        parallelSimulationWithDrug(popSize // 10, popSize, 0.1, 0.05, drugs, mutProb, {timeSteps // 2: drugs[0]},
+                                   numTrials=1, timeSteps=timeSteps, engine=engine, seed=0, workers=1)
+    return lambda: None, run, timeSteps, popSize // 10 * timeSteps
+
+
+# name : (benchmark function, varies with drugs and mutProb, varies with engine)
+BENCHMARKS = {
+    'Patient.update'          : (benchPatientUpdate, False, False),
+    'TreatedPatient.update'   : (benchTreatedPatientUpdate, True, False),
+    'ResistantVirus.reproduce': (benchReproduce, True, False),
+    'getResistPop'            : (benchGetResistPop, True, False),
+    'simulationWithDrug'      : (benchSimulationWithDrug, True, True),
+}
+
+
+def runSuite(sizes, drugCounts, mutProbs, engines, benchmarks=None, repeats=3, trackMemory=True, log=print):
+    """
+    Runs every benchmark over the grid of population sizes, drug counts,
+    mutation probabilities and engines it depends on.
+
+    returns: a list of result records (dictionaries)
+    """
+    results = []
+    for name, (benchmark, variesWithDrugs, variesWithEngine) in BENCHMARKS.items():
+        if benchmarks is not None and name not in benchmarks:
+            continue
+        grid = [(popSize, numDrugs, mutProb, engine)
+                for popSize in sizes
+                for numDrugs in (drugCounts if variesWithDrugs else drugCounts[:1])
+                for mutProb in (mutProbs if variesWithDrugs else mutProbs[:1])
+                for engine in (engines if variesWithEngine else ['object'])]
+        for popSize, numDrugs, mutProb, engine in grid:
+            setup, run, steps, particles = benchmark(popSize, numDrugs, mutProb, engine)
+            seconds, peakMemory = measure(setup, run, repeats, trackMemory)
+            record = {
+                'benchmark'       : name,
+                'popSize'         : popSize,
+                'numDrugs'        : numDrugs,
+                'mutProb'         : mutProb,
+                'engine'          : engine,
+                'seconds'         : seconds,
+                'stepsPerSec'     : steps / seconds,
+                'particlesPerSec' : particles / seconds,
+                'peakMemory'      : peakMemory,
+            }
+            results.append(record)
+            log(formatRecord(record))
+    return results
+
+
+def formatRecord(record, baseline=None):
+    """
+    Returns a one line summary of a result record, with the speedup over the
+    matching baseline record if there is one.
+    """
+    line = (f'{record["benchmark"]:<26}{record["engine"]:<8}n={record["popSize"]:<9}drugs={record["numDrugs"]:<4}'
+            f'mut={record["mutProb"]:<7}{record["stepsPerSec"]:12.1f} steps/s{record["particlesPerSec"]:14.0f} particles/s')
+    if record['peakMemory'] is not None:
+        line += f'{record["peakMemory"] / 2**20:10.1f} MiB'
+    if baseline is not None:
+        line += f'  x{record["particlesPerSec"] / baseline["particlesPerSec"]:.2f}'
+    return line
+
+
+def recordKey(record):
+    return (record['benchmark'], record['popSize'], record['numDrugs'], record['mutProb'], record['engine'])
+
+
+def gitCommit():
+    """
+    Returns the commit hash of the checkout holding this file, or None outside
+    of git.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def saveResults(path, results):
+    """
+    Writes the results and a description of the run environment as JSON.
+    """
+    report = {
+        'commit'   : gitCommit(),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results'  : results,
+    }
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=1)
+
+
+def compareResults(results, baselinePath):
+    """
+    Prints every result with its speedup over the matching result saved in
+    baselinePath.
+    """
+    with open(baselinePath) as file:
+        baseline = {recordKey(record): record for record in json.load(file)['results']}
+    for record in results:
+        print(formatRecord(record, baseline.get(recordKey(record))))
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the virus population simulation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--drugs', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--mut-probs', type=float, nargs='+', default=[0.0, 0.005, 0.05])
+    parser.add_argument('--engines', nargs='+', default=['object', 'numpy', 'counts'])
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--quick', action='store_true', help='only populations of 1e3 and 1e4')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of earlier results to compare with')
+    parser.add_argument('--scaling', action='store_true', help='only check that update() scales linearly')
+    args = parser.parse_args(argv)
+
+    if args.scaling:
+        return 0 if benchmarkUpdateScaling() else 1
+
+    sizes = [1000, 10000] if args.quick else args.sizes
+    results = runSuite(sizes, args.drugs, args.mut_probs, args.engines, args.benchmarks, args.repeats,
+                       not args.no_memory, log=(lambda line: None) if args.compare else print)
+    if args.compare:
+        compareResults(results, args.compare)
+    if args.output:
+        saveResults(args.output, results)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# Checkpoints of TreatedPatient simulations
+"""
+Binary snapshots of the full state of a TreatedPatient: virus population,
+prescriptions, time step and state of its random numbers (the random module
+or the patient's BlockRandom). A checkpoint file is
+a small JSON header followed by two raw arrays, one strain number and one
+little-endian resistance bitmask per particle, aligned so that they can be
+memory-mapped. Opening a checkpoint only maps the file; many schedule
+variants can then be restored from the same checkpoint instead of simulating
+the shared prefix again.
+
+File layout: MAGIC, the header length (8 bytes, little-endian), the JSON
+header, then the strain numbers and resistance bitmasks at the offsets given
+in the header.
+"""
+
+import json
+import random
+
+import numpy as np
+
+from ps3b import Strain, ResistantVirus, TreatedPatient
+
+
+
+MAGIC = b'PS3BCKPT'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def saveCheckpoint(path, patient, timeStep=0, saveRandom=True):
+    """
+    Writes the state of patient to a checkpoint file.
+
+    path: name of the file to write
+
+    patient: a TreatedPatient holding ResistantVirus particles
+
+    timeStep: index of the next time step to simulate (an integer)
+
+    saveRandom: whether to save the state of the random numbers, so that the
+    restored simulation continues with the same random draws: the state of
+    the random module for patients whose rng is None, the state of the rng
+    for patients drawing from a ps3b_rng.BlockRandom (other rngs are not
+    saved)
+    """
+    rng = patient.rng
+    strainNumbers = {}
+    strains = []
+    numbers = np.empty(len(patient.viruses), dtype=np.uint32)
+    bitBytes = 1
+    for i, virus in enumerate(patient.viruses):
+        strain = virus.strain
+        if strain not in strainNumbers:
+            strainNumbers[strain] = len(strains)
+            strains.append([strain.maxBirthProb, strain.clearProb, strain.mutProb, list(strain.drugs)])
+            bitBytes = max(bitBytes, -(-len(strain.drugs) // 8))
+        numbers[i] = strainNumbers[strain]
+
+    resistBits = b''.join(virus.resistBits.to_bytes(bitBytes, 'little') for virus in patient.viruses)
+
+    header = {
+        'version'       : VERSION,
+        'maxPop'        : patient.getMaxPop(),
+        'timeStep'      : timeStep,
+        'prescriptions' : patient.getPrescriptions(),
+        'strains'       : strains,
+        'count'         : len(patient.viruses),
+        'bitBytes'      : bitBytes,
+        'random'        : random.getstate() if saveRandom and rng is None else None,
+        'rng'           : rng.getState() if saveRandom and hasattr(rng, 'getState') else None,
+    }
+    # The offsets depend on the header length, which depends on the offsets
+    header['strainOffset'] = header['bitsOffset'] = 0
+    while True:
+        headerBytes = json.dumps(header).encode('utf-8')
+        strainOffset = _align(len(MAGIC) + 8 + len(headerBytes))
+        bitsOffset = _align(strainOffset + numbers.nbytes)
+        if (header['strainOffset'], header['bitsOffset']) == (strainOffset, bitsOffset):
+            break
+        header['strainOffset'], header['bitsOffset'] = strainOffset, bitsOffset
+
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(headerBytes).to_bytes(8, 'little'))
+        file.write(headerBytes)
+        file.write(b'\0' * (strainOffset - file.tell()))
+        file.write(numbers.tobytes())
+        file.write(b'\0' * (bitsOffset - file.tell()))
+        file.write(resistBits)
+
+
+
+class Checkpoint(object):
+    """
+    A checkpoint file opened with memory-mapping. The header fields are read
+    at once, the population arrays are only paged in when a patient is
+    restored.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the checkpoint file at path.
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a checkpoint file')
+            headerLength = int.from_bytes(file.read(8), 'little')
+            self.header = json.loads(file.read(headerLength))
+        if self.header['version'] != VERSION:
+            raise ValueError(f'Unsupported checkpoint version {self.header["version"]}')
+
+        count = self.header['count']
+        bitBytes = self.header['bitBytes']
+        if count:
+            self.strainNumbers = np.memmap(path, dtype=np.uint32, mode='r', offset=self.header['strainOffset'], shape=(count,))
+            self.resistBits = np.memmap(path, dtype=np.uint8, mode='r', offset=self.header['bitsOffset'], shape=(count, bitBytes))
+        else:
+            self.strainNumbers = np.empty(0, dtype=np.uint32)
+            self.resistBits = np.empty((0, bitBytes), dtype=np.uint8)
+
+    def getTimeStep(self):
+        """
+        Returns the index of the next time step to simulate.
+        """
+        return self.header['timeStep']
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that were being administered at the checkpoint.
+        """
+        return self.header['prescriptions'][:]
+
+    def restore(self, restoreRandom=True, rng=None):
+        """
+        Creates a new TreatedPatient in the state saved in this checkpoint.
+        Every call returns an independent patient.
+
+        restoreRandom: whether to also reset the random module to its saved
+        state (if one was saved), and to give the patient a BlockRandom
+        continuing its saved rng (if one was saved and rng is None)
+
+        rng: the source of random numbers of the patient, see Patient
+
+        returns: the patient (a TreatedPatient)
+        """
+        strains = [Strain.intern(*params) for params in self.header['strains']]
+
+        bitBytes = self.header['bitBytes']
+        if bitBytes <= 8:
+            # Widen the bitmasks to 64 bits and convert them all at once
+            padded = np.zeros((self.header['count'], 8), dtype=np.uint8)
+            padded[:, :bitBytes] = self.resistBits
+            resistBits = padded.view('<u8').ravel().tolist()
+        else:
+            rows = self.resistBits.tobytes()
+            resistBits = [int.from_bytes(rows[i:i + bitBytes], 'little') for i in range(0, len(rows), bitBytes)]
+        viruses = [ResistantVirus._withBits(strains[number], bits)
+                   for number, bits in zip(self.strainNumbers.tolist(), resistBits)]
+
+        rngState = self.header.get('rng')
+        if restoreRandom and rng is None and rngState is not None:
+            from ps3b_rng import BlockRandom
+            rng = BlockRandom.fromState(rngState)
+
+        patient = TreatedPatient(viruses, self.header['maxPop'], rng)
+        for drug in self.header['prescriptions']:
+            patient.addPrescription(drug)
+
+        state = self.header['random']
+        if restoreRandom and state is not None:
+            random.setstate((state[0], tuple(state[1]), state[2]))
+        return patient
+
+
+def loadCheckpoint(path, restoreRandom=True):
+    """
+    Restores a patient from a checkpoint file.
+
+    returns: a tuple (patient, index of the next time step to simulate)
+    """
+    checkpoint = Checkpoint(path)
+    return checkpoint.restore(restoreRandom), checkpoint.getTimeStep()
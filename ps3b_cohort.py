@@ -0,0 +1,187 @@
+# Batched simulation of patient cohorts
+"""
+Simulation of a cohort of treated patients in one set of arrays. Every
+patient's virus population is a row of genotype counts, like the table of
+GenotypeCountPatient: column g holds the number of particles whose resistance
+bitmask is g. Each patient has its own maxPop, birth, clearance and mutation
+probabilities and active drugs (a bitmask per patient), and one update()
+draws the clearance, birth and mutation counts of all patients and genotypes
+at once. Memory grows with patients * 2^len(drugs).
+"""
+
+import numpy as np
+
+
+
+class Cohort(object):
+    """
+    Representation of many TreatedPatients whose viruses are ResistantVirus
+    particles, all starting with no resistance.
+    """
+
+    def __init__(self, startPops, maxPops, maxBirthProbs, clearProbs, drugs, mutProbs, rng=None):
+        """
+        Initialization function. Every parameter but drugs and rng is either
+        one value shared by all patients or an array with one value per
+        patient; the number of patients is the length of those arrays.
+
+        startPops: initial number of virus particles (integers)
+        maxPops: maximum virus population (integers)
+        maxBirthProbs: Maximum reproduction probability (floats between 0-1)
+        clearProbs: Maximum clearance probability (floats between 0-1)
+        drugs: the drug names (strings), at most 20
+        mutProbs: Mutation probability of each resistance trait (floats)
+        rng: a numpy Generator or a seed for one (optional)
+        """
+        if len(drugs) > 20:
+            raise ValueError('Cohort supports at most 20 drugs')
+        startPops, maxPops, maxBirthProbs, clearProbs, mutProbs = np.broadcast_arrays(
+            startPops, maxPops, maxBirthProbs, clearProbs, mutProbs)
+        numPatients = len(np.atleast_1d(startPops))
+
+        self.drugs = list(drugs)
+        self.maxPops = np.array(np.atleast_1d(maxPops), dtype=np.float64)
+        self.maxBirthProbs = np.array(np.atleast_1d(maxBirthProbs), dtype=np.float64)
+        self.clearProbs = np.array(np.atleast_1d(clearProbs), dtype=np.float64)
+        self.mutProbs = np.array(np.atleast_1d(mutProbs), dtype=np.float64)
+        self.rng = np.random.default_rng(rng)
+
+        self.genotypes = np.arange(2 ** len(self.drugs))
+        self.counts = np.zeros((numPatients, len(self.genotypes)), dtype=np.int64)
+        self.counts[:, 0] = np.atleast_1d(startPops)
+        self.activeDrugs = np.zeros(numPatients, dtype=np.int64)
+
+    def getNumPatients(self):
+        """
+        Returns the number of patients in the cohort.
+        """
+        return len(self.counts)
+
+    def _drugBits(self, drugs):
+        """
+        Returns the bitmask of a list of drug names.
+        """
+        bits = 0
+        for drug in drugs:
+            bits |= 1 << self.drugs.index(drug)
+        return bits
+
+    def addPrescription(self, newDrug, patients=None):
+        """
+        Administer a drug to some patients of the cohort. Patients who already
+        take the drug are not affected.
+
+        newDrug: The name of the drug to administer (a string), one of drugs
+
+        patients: indices or boolean mask of the patients who get the drug
+        (None for every patient)
+        """
+        if patients is None:
+            patients = slice(None)
+        self.activeDrugs[patients] |= self._drugBits([newDrug])
+
+    def getTotalPops(self):
+        """
+        Returns the total virus population of every patient (an array of
+        integers).
+        """
+        return self.counts.sum(axis=1)
+
+    def getResistPops(self, drugResist=None):
+        """
+        Returns the number of virus particles of every patient that are
+        resistant to all the drugs in drugResist (a list of drug names), or to
+        all the drugs each patient takes if drugResist is None.
+        """
+        if drugResist is None:
+            masks = self.activeDrugs[:, None]
+        else:
+            masks = self._drugBits(drugResist)
+        resistant = self.genotypes & masks == masks
+        return np.where(resistant, self.counts, 0).sum(axis=1)
+
+    def getResistanceHistograms(self):
+        """
+        Returns the number of particles of every patient resistant to each
+        drug, an array of shape (patients, drugs).
+        """
+        bits = (self.genotypes[:, None] >> np.arange(len(self.drugs))) & 1
+        return self.counts @ bits
+
+    def update(self):
+        """
+        Update the virus populations of all the patients for a single time
+        step, in the same order as TreatedPatient.update(): clearance, then
+        population density, then reproduction and mutation.
+
+        returns: The total virus population of every patient at the end of the
+        update (an array of integers)
+        """
+        self.counts -= self.rng.binomial(self.counts, self.clearProbs[:, None])
+
+        popDensities = self.counts.sum(axis=1) / self.maxPops
+
+        # Only genotypes resistant to every drug the patient takes reproduce
+        birthProbs = np.maximum(0.0, self.maxBirthProbs * (1 - popDensities))
+        canReproduce = self.genotypes & self.activeDrugs[:, None] == self.activeDrugs[:, None]
+        births = np.where(canReproduce, self.rng.binomial(self.counts, birthProbs[:, None]), 0)
+
+        # Split the offspring one resistance trait at a time: the flipped ones
+        # move from genotype g to genotype g ^ bit
+        for bit in range(len(self.drugs)):
+            flipped = self.rng.binomial(births, self.mutProbs[:, None])
+            births += flipped[:, self.genotypes ^ (1 << bit)] - flipped
+
+        self.counts += births
+        return self.getTotalPops()
+
+    def run(self, timeSteps, timelyPrescriptions={}):
+        """
+        Runs the cohort for timeSteps time steps.
+
+        timelyPrescriptions: {timeStep : drug name or list of drug names to add
+        before that time step} applied to every patient, or a list with one
+        such dictionary per patient
+
+        returns: a tuple (total population, resistant population) of arrays of
+        shape (timeSteps, patients), the resistant population of a patient
+        being resistant to all the drugs that patient takes
+        """
+        if isinstance(timelyPrescriptions, dict):
+            timelyPrescriptions = [timelyPrescriptions] * self.getNumPatients()
+
+        # Drug bits to add to each patient, per time step
+        events = {}
+        for patient, prescriptions in enumerate(timelyPrescriptions):
+            for timeStep, newDrugs in prescriptions.items():
+                newDrugs = [newDrugs] if isinstance(newDrugs, str) else newDrugs
+                bits = events.setdefault(timeStep, np.zeros(self.getNumPatients(), dtype=np.int64))
+                bits[patient] |= self._drugBits(newDrugs)
+
+        totalPops = np.empty((timeSteps, self.getNumPatients()), dtype=np.int64)
+        resistPops = np.empty_like(totalPops)
+        for timeStep in range(timeSteps):
+            if timeStep in events:
+                self.activeDrugs |= events[timeStep]
+            totalPops[timeStep] = self.update()
+            resistPops[timeStep] = self.getResistPops()
+        return totalPops, resistPops
+
+    def summary(self):
+        """
+        Returns cohort-level statistics of the current virus populations: the
+        mean, median, 10th and 90th percentile of the total population, the
+        fraction of patients whose population died out and the mean fraction
+        of each patient's viruses resistant to the drugs the patient takes.
+        """
+        totals = self.getTotalPops()
+        resistant = self.getResistPops()
+        fractions = np.divide(resistant, totals, out=np.zeros(len(totals)), where=totals > 0)
+        return {
+            'meanTotalPop'        : float(totals.mean()),
+            'medianTotalPop'      : float(np.median(totals)),
+            'p10TotalPop'         : float(np.percentile(totals, 10)),
+            'p90TotalPop'         : float(np.percentile(totals, 90)),
+            'extinctFraction'     : float(np.mean(totals == 0)),
+            'meanResistFraction'  : float(fractions.mean()),
+        }
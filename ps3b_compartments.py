@@ -0,0 +1,270 @@
+# Multi-compartment patients
+"""
+A treated patient whose body is a graph of compartments (tissues) instead of
+one well-mixed pool. Each compartment has its own maxPop, so its own
+population density, and its own penetration of each drug; particles migrate
+between compartments along the edges of the graph.
+
+As in Cohort, the population of compartment c is a row of genotype counts
+(column g holds the particles whose resistance bitmask is g), so all the
+compartments are updated at once with batched binomial draws:
+
+- clearance, density, reproduction and mutation, independently in each
+  compartment, in the order of TreatedPatient.update()
+- then migration: every particle of compartment i moves to compartment j
+  with probability migration[i, j], drawn for all the edges leaving the
+  compartments at once
+
+Drug penetration generalizes the all-or-nothing effect of a drug: where a
+drug d is prescribed, a particle not resistant to it reproduces with its
+probability multiplied by 1 - penetration[c, d]. With a penetration of 1
+everywhere and no migration, each compartment behaves like a TreatedPatient
+of the counts engine. Memory grows with compartments * 2^len(drugs).
+"""
+
+import numpy as np
+
+
+
+class CompartmentPatient(object):
+    """
+    Representation of a patient made of compartments connected by migration,
+    whose viruses are ResistantVirus particles.
+    """
+
+    def __init__(self, startPops, maxPops, maxBirthProb, clearProb, drugs, mutProb, penetration=1.0, migration=None, rng=None):
+        """
+        Initialization function. The number of compartments is the length of
+        maxPops.
+
+        startPops: initial number of particles, all without resistance, in
+        each compartment (an integer or an array of integers)
+
+        maxPops: maximum virus population of each compartment (an array of
+        integers)
+
+        maxBirthProb, clearProb, mutProb: as for TreatedPatient, either one
+        value or one per compartment (floats between 0-1)
+
+        drugs: the drug names (strings), at most 20
+
+        penetration: fraction of the effect of each drug reaching each
+        compartment, broadcast to shape (compartments, drugs) (floats
+        between 0-1)
+
+        migration: per-step probability that a particle moves from
+        compartment i to compartment j, a matrix of shape (compartments,
+        compartments) whose rows sum to at most 1 (the diagonal is ignored),
+        or None for no migration
+
+        rng: a numpy Generator or a seed for one (optional)
+        """
+        if len(drugs) > 20:
+            raise ValueError('CompartmentPatient supports at most 20 drugs')
+        self.maxPops = np.array(np.atleast_1d(maxPops), dtype=np.float64)
+        numCompartments = len(self.maxPops)
+        self.maxBirthProbs = np.broadcast_to(np.asarray(maxBirthProb, dtype=np.float64), (numCompartments,)).copy()
+        self.clearProbs = np.broadcast_to(np.asarray(clearProb, dtype=np.float64), (numCompartments,)).copy()
+        self.mutProbs = np.broadcast_to(np.asarray(mutProb, dtype=np.float64), (numCompartments,)).copy()
+        self.drugs = list(drugs)
+        self.penetration = np.broadcast_to(np.asarray(penetration, dtype=np.float64),
+                                           (numCompartments, len(self.drugs))).copy()
+        self.rng = np.random.default_rng(rng)
+
+        self.genotypes = np.arange(2 ** len(self.drugs))
+        self.counts = np.zeros((numCompartments, len(self.genotypes)), dtype=np.int64)
+        self.counts[:, 0] = np.broadcast_to(startPops, (numCompartments,))
+        self.activeDrugs = 0
+        self.birthFactors = None
+        self.setMigration(migration)
+
+    def setMigration(self, migration):
+        """
+        Sets the migration matrix (see __init__). The edges are grouped into
+        slots, slot k holding the k-th edge of every compartment, so that
+        migration draws one batch per slot; the number of draws per step is
+        the largest out-degree of the graph, not the number of edges.
+        """
+        numCompartments = self.getNumCompartments()
+        if migration is None:
+            migration = np.zeros((numCompartments, numCompartments))
+        migration = np.array(migration, dtype=np.float64)
+        if migration.shape != (numCompartments, numCompartments):
+            raise ValueError('migration must be a square matrix with one row per compartment')
+        np.fill_diagonal(migration, 0.0)
+        if np.any(migration < 0) or np.any(migration.sum(axis=1) > 1 + 1e-12):
+            raise ValueError('migration probabilities must be non-negative with rows summing to at most 1')
+
+        sources, targets = np.nonzero(migration)
+        probs = migration[sources, targets]
+        # Rank of each edge among the edges of its source
+        firstEdge = np.searchsorted(sources, np.arange(numCompartments))
+        ranks = np.arange(len(sources)) - firstEdge[sources]
+        self.migrationSlots = []
+        for rank in range(ranks.max() + 1 if len(ranks) else 0):
+            edges = ranks == rank
+            self.migrationSlots.append((sources[edges], targets[edges], probs[edges]))
+
+    def getNumCompartments(self):
+        """
+        Returns the number of compartments.
+        """
+        return len(self.counts)
+
+    def getMaxPop(self):
+        """
+        Returns the max population, summed over the compartments.
+        """
+        return int(self.maxPops.sum())
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. The drug reaches every compartment
+        according to its penetration. If the newDrug is already prescribed
+        to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer (a string), one of drugs
+        """
+        bit = 1 << self.drugs.index(newDrug)
+        if not self.activeDrugs & bit:
+            self.activeDrugs |= bit
+            self.birthFactors = None
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+        """
+        return [drug for bit, drug in enumerate(self.drugs) if self.activeDrugs >> bit & 1]
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population, summed over the
+        compartments (an integer).
+        """
+        return int(self.counts.sum())
+
+    def getCompartmentPops(self):
+        """
+        Returns the virus population of each compartment (an array of
+        integers).
+        """
+        return self.counts.sum(axis=1)
+
+    def _drugBits(self, drugs):
+        bits = 0
+        for drug in drugs:
+            if drug not in self.drugs:
+                return None
+            bits |= 1 << self.drugs.index(drug)
+        return bits
+
+    def getCompartmentResistPops(self, drugResist):
+        """
+        Returns the number of particles of each compartment resistant to all
+        the drugs in drugResist (an array of integers).
+        """
+        mask = self._drugBits(drugResist)
+        if mask is None:
+            return np.zeros(self.getNumCompartments(), dtype=np.int64)
+        return self.counts[:, self.genotypes & mask == mask].sum(axis=1)
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist, summed over the compartments.
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        return int(self.getCompartmentResistPops(drugResist).sum())
+
+    def getGenotypeCounts(self):
+        """
+        Returns the number of particles of each genotype over all the
+        compartments, a dictionary mapping resistance bitmasks (bit j set for
+        resistance to drugs[j]) onto counts.
+        """
+        totals = self.counts.sum(axis=0)
+        return {int(mask): int(count) for mask, count in enumerate(totals) if count}
+
+    def _getBirthFactors(self):
+        """
+        Returns the factor of the birth probability of each genotype in each
+        compartment due to the drugs (shape (compartments, genotypes)),
+        recomputed only when the prescriptions change.
+        """
+        if self.birthFactors is None:
+            # Drugs each genotype is exposed to: active and not resisted
+            bits = np.arange(len(self.drugs))
+            exposed = ((self.activeDrugs & ~self.genotypes)[:, None] >> bits) & 1
+            logKept = np.log(np.maximum(1.0 - self.penetration, 1e-300))
+            self.birthFactors = np.exp(logKept @ exposed.T)
+            self.birthFactors[self.birthFactors < 1e-250] = 0.0
+        return self.birthFactors
+
+    def _migrate(self):
+        """
+        Moves particles along the migration edges. The edges of a
+        compartment split its particles one slot at a time: edge k takes each
+        remaining particle with its probability divided by the probability
+        left after the previous edges.
+        """
+        if not self.migrationSlots:
+            return
+        remaining = self.counts
+        arrivals = np.zeros_like(self.counts)
+        probLeft = np.ones(self.getNumCompartments())
+        for sources, targets, probs in self.migrationSlots:
+            condProbs = np.minimum(1.0, probs / np.maximum(probLeft[sources], 1e-300))
+            moved = self.rng.binomial(remaining[sources], condProbs[:, None])
+            remaining[sources] -= moved
+            probLeft[sources] -= probs
+            np.add.at(arrivals, targets, moved)
+        self.counts = remaining + arrivals
+
+    def update(self):
+        """
+        Update the virus populations of all the compartments for a single time
+        step: clearance, population density, reproduction and mutation in
+        each compartment, then migration between compartments.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        self.counts -= self.rng.binomial(self.counts, self.clearProbs[:, None])
+
+        popDensities = self.counts.sum(axis=1) / self.maxPops
+
+        birthProbs = np.maximum(0.0, self.maxBirthProbs * (1 - popDensities))
+        births = self.rng.binomial(self.counts, birthProbs[:, None] * self._getBirthFactors())
+
+        # Split the offspring one resistance trait at a time, see Cohort
+        for bit in range(len(self.drugs)):
+            flipped = self.rng.binomial(births, self.mutProbs[:, None])
+            births += flipped[:, self.genotypes ^ (1 << bit)] - flipped
+
+        self.counts += births
+        self._migrate()
+        return self.getTotalPop()
+
+    def run(self, timeSteps, timelyPrescriptions={}):
+        """
+        Runs the patient for timeSteps time steps.
+
+        timelyPrescriptions: {timeStep : drug name or list of drug names to add
+        before that time step}
+
+        returns: a tuple (total population, resistant population) of arrays of
+        shape (timeSteps, compartments), the resistant population being
+        resistant to all the drugs prescribed at that time
+        """
+        totalPops = np.empty((timeSteps, self.getNumCompartments()), dtype=np.int64)
+        resistPops = np.empty_like(totalPops)
+        for timeStep in range(timeSteps):
+            newDrugs = timelyPrescriptions.get(timeStep, [])
+            for drug in [newDrugs] if isinstance(newDrugs, str) else newDrugs:
+                self.addPrescription(drug)
+            self.update()
+            totalPops[timeStep] = self.getCompartmentPops()
+            resistPops[timeStep] = self.getCompartmentResistPops(self.getPrescriptions())
+        return totalPops, resistPops
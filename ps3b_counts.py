@@ -0,0 +1,221 @@
+# Count-based engine for the virus population simulation
+"""
+Genotype-bucketed version of TreatedPatient. All ResistantVirus particles that
+share maxBirthProb, clearProb, mutProb and resistances behave identically, so
+the population is stored as a table {resistance bitmask: number of particles}
+instead of one object per particle. At each time step the number of cleared
+particles, offspring and mutated offspring of every genotype is drawn from a
+binomial distribution. Memory grows with the number of genotypes present (at
+most 2^len(drugs)), not with maxPop.
+"""
+
+import numpy as np
+
+from ps3b import ResistantVirus
+
+
+
+def genotypeMask(resistances, drugs):
+    """
+    Returns the bitmask of a genotype: bit j is set if the virus is resistant
+    to drugs[j].
+
+    resistances: A dictionary of drug names (strings) mapping to the state of
+    the resistance (either True or False) to each drug.
+
+    drugs: the drug names (strings), giving the bit order
+    """
+    mask = 0
+    for bit, drug in enumerate(drugs):
+        if resistances.get(drug, False):
+            mask |= 1 << bit
+    return mask
+
+
+
+class GenotypeCountPatient(object):
+    """
+    Count-based equivalent of TreatedPatient, for a population of particles
+    sharing maxBirthProb, clearProb and mutProb.
+
+    Subclasses can replace the exact binomial draws of update() by
+    approximations by overriding _draw, countType and minCount (see
+    ps3b_approx).
+    """
+    # Type of the particle counts during update()
+    countType = np.int64
+    # Genotypes with no more particles than this are dropped
+    minCount = 0
+
+    def __init__(self, maxBirthProb, clearProb, mutProb, drugs, counts, maxPop, rng=None):
+        """
+        Initialization function, saves all parameters as attributes. Also
+        initializes the list of drugs being administered (which initially
+        includes no drugs).
+
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+
+        clearProb: Maximum clearance probability (a float between 0-1)
+
+        mutProb: Mutation probability of each resistance trait (a float)
+
+        drugs: the drug names (strings), bit j of a genotype is the resistance
+        to drugs[j]; at most 64 drugs
+
+        counts: the virus population, a dictionary mapping genotype bitmasks
+        (integers) to the number of particles with that genotype
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: a numpy Generator or a seed for one (optional)
+        """
+        if len(drugs) > 64:
+            raise ValueError('GenotypeCountPatient supports at most 64 drugs')
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.drugs = list(drugs)
+        self.counts = {mask: count for mask, count in counts.items() if count > 0}
+        self.maxPop = maxPop
+        self.rng = np.random.default_rng(rng)
+        self.prescriptions = []
+
+    @classmethod
+    def fromParameters(cls, startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng=None):
+        """
+        Builds a GenotypeCountPatient holding startPop identical particles,
+        the count equivalent of startPop ResistantVirus(maxBirthProb,
+        clearProb, resistances, mutProb) instances.
+        """
+        drugs = list(resistances)
+        counts = {genotypeMask(resistances, drugs): startPop}
+        return cls(maxBirthProb, clearProb, mutProb, drugs, counts, maxPop, rng)
+
+    def getGenotypeCounts(self):
+        """
+        Returns a copy of the table {genotype bitmask: number of particles}.
+        """
+        return dict(self.counts)
+
+    def getViruses(self):
+        """
+        Returns the viruses in this patient as a list of ResistantVirus
+        instances. This builds a new object per particle and is only meant for
+        inspection.
+        """
+        viruses = []
+        for mask, count in self.counts.items():
+            resistances = {drug: bool(mask >> bit & 1) for bit, drug in enumerate(self.drugs)}
+            for i in range(count):
+                viruses.append(ResistantVirus(self.maxBirthProb, self.clearProb, dict(resistances), self.mutProb))
+        return viruses
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return sum(self.counts.values())
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. If the newDrug is already prescribed
+        to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer to the patient (a string).
+        """
+        if newDrug not in self.prescriptions:
+            self.prescriptions.append(newDrug)
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+        """
+        return self.prescriptions[:]
+
+    def _drugMask(self, drugs):
+        """
+        Returns the bitmask with the bits of drugs set, or None if some drug is
+        not tracked by this patient (no particle is resistant to an unknown
+        drug).
+        """
+        mask = 0
+        for drug in drugs:
+            if drug not in self.drugs:
+                return None
+            mask |= 1 << self.drugs.index(drug)
+        return mask
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        need = self._drugMask(drugResist)
+        if need is None:
+            return 0
+        return sum(count for mask, count in self.counts.items() if mask & need == need)
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as TreatedPatient.update(): clearance,
+        then population density, then reproduction and mutation.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        masks = np.fromiter(self.counts.keys(), dtype=np.uint64, count=len(self.counts))
+        counts = np.fromiter(self.counts.values(), dtype=self.countType, count=len(self.counts))
+
+        counts = counts - self._draw(counts, self.clearProb)
+
+        popDensity = counts.sum() / self.getMaxPop()
+
+        # Only genotypes resistant to every active drug reproduce
+        birthProb = max(0.0, self.maxBirthProb * (1 - popDensity))
+        active = self._drugMask(self.prescriptions)
+        if active is None:
+            births = np.zeros_like(counts)
+        else:
+            active = np.uint64(active)
+            births = np.where(masks & active == active, self._draw(counts, birthProb), 0)
+
+        # Every resistance trait of every offspring flips independently, so
+        # the offspring of each genotype can be split one bit at a time
+        childMasks, childCounts = masks, births
+        if self.mutProb > 0:
+            for bit in range(len(self.drugs)):
+                flipped = self._draw(childCounts, self.mutProb)
+                childMasks = np.concatenate((childMasks, childMasks ^ np.uint64(1 << bit)))
+                childCounts = np.concatenate((childCounts - flipped, flipped))
+                nonEmpty = childCounts > self.minCount
+                childMasks, childCounts = childMasks[nonEmpty], childCounts[nonEmpty]
+
+        newCounts = {}
+        for mask, count in zip(np.concatenate((masks, childMasks)).tolist(),
+                               np.concatenate((counts, childCounts)).tolist()):
+            if count > self.minCount:
+                newCounts[mask] = newCounts.get(mask, 0) + count
+        self.counts = newCounts
+
+        return self.getTotalPop()
+
+    def _draw(self, counts, prob):
+        """
+        Returns how many of the particles of each genotype go through an event
+        of probability prob: one binomial draw per entry of the array counts.
+        """
+        return self.rng.binomial(counts, prob)
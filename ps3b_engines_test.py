@@ -0,0 +1,160 @@
+# Automated checks of the simulation engines, run with pytest
+"""
+Checks of the claims the engines make about each other:
+
+- the object engine is reproducible from a seed (ps3b_rng), and
+  TreatedPatient.update() draws the same random numbers as a loop over
+  ResistantVirus.doesClear and ResistantVirus.reproduce, also above maxPop
+  (the per-step probability tables and resistance bitmasks of ps3b)
+- TreatedPatient.getGenotypeCounts() of strains listing their drugs in
+  different orders
+- profiled (ps3b_profile), checkpointed and pickled (ps3b_checkpoint) and
+  parallel (ps3b_parallel) runs follow the same seeded trajectories as plain
+  runs
+- the numpy (ps3b_vectorized), counts (ps3b_counts), cohort (ps3b_cohort)
+  and compartment (ps3b_compartments) engines give the same mean curves as
+  the object engine, within a few standard errors
+
+The other modules have their own ps3b_*_test.py.
+
+Every check is seeded, so the statistical comparisons are deterministic.
+"""
+
+import pickle
+import random
+
+import numpy as np
+
+from ps3b import NoChildException, ResistantVirus, TreatedPatient, runSimulationWithDrug, runTrialWithDrug
+from ps3b_checkpoint import loadCheckpoint, saveCheckpoint
+from ps3b_cohort import Cohort
+from ps3b_compartments import CompartmentPatient
+from ps3b_parallel import parallelSimulationWithDrug
+from ps3b_profile import ProfiledTreatedPatient
+from ps3b_rng import BlockRandom
+
+
+
+PARAMS = (100, 1000, 0.1, 0.05, ['A', 'B'], 0.005)
+PRESCRIPTIONS = {75: 'A'}
+TIME_STEPS = 150
+NUM_TRIALS = 40
+
+
+def runPatient(patient, firstStep, lastStep, timelyPrescriptions=PRESCRIPTIONS):
+    """
+    Runs patient from firstStep up to lastStep and returns the (total,
+    resistant) population after every step.
+    """
+    populations = []
+    for timeStep in range(firstStep, lastStep):
+        if timeStep in timelyPrescriptions:
+            patient.addPrescription(timelyPrescriptions[timeStep])
+        populations.append((patient.update(), patient.getResistPop(patient.getPrescriptions())))
+    return populations
+
+
+def newPatient(startPop, seed, patientClass=TreatedPatient):
+    maxBirthProb, clearProb, mutProb = 0.1, 0.05, 0.05
+    viruses = [ResistantVirus(maxBirthProb, clearProb, {'A': False, 'B': True}, mutProb) for i in range(startPop)]
+    return patientClass(viruses, 1000, BlockRandom(seed))
+
+
+
+def testSeededTrajectoryIsReproducible():
+    random.seed(1)
+    first = runTrialWithDrug(*PARAMS, PRESCRIPTIONS, TIME_STEPS, rng=7)
+    random.seed(2)
+    second = runTrialWithDrug(*PARAMS, PRESCRIPTIONS, TIME_STEPS, rng=7)
+    assert first == second
+    assert first != runTrialWithDrug(*PARAMS, PRESCRIPTIONS, TIME_STEPS, rng=8)
+
+
+def testUpdateDrawsLikeReproduce():
+    # Below and above maxPop (negative birth probabilities)
+    for startPop in (100, 1500):
+        patient = newPatient(startPop, 3)
+        viruses = list(patient.viruses)
+        rng = BlockRandom(3)
+        for timeStep in range(120):
+            if timeStep == 60:
+                patient.addPrescription('A')
+            patient.update()
+
+            viruses = [virus for virus in viruses if not virus.doesClear(rng)]
+            popDensity = len(viruses) / 1000
+            offspring = []
+            for virus in viruses:
+                try:
+                    offspring.append(virus.reproduce(popDensity, patient.getPrescriptions(), rng))
+                except NoChildException:
+                    pass
+            viruses.extend(offspring)
+
+            assert [virus.resistBits for virus in patient.viruses] == [virus.resistBits for virus in viruses]
+
+
+def testGenotypeCountsOfMixedStrains():
+    # Two strains listing the same drugs in different orders
+    patient = TreatedPatient([ResistantVirus(0.1, 0.05, {'A': True, 'B': False}, 0.0),
+                              ResistantVirus(0.2, 0.05, {'B': True, 'A': False}, 0.0)], 1000)
+    assert patient.getDrugs() == ['A', 'B']
+    assert patient.getGenotypeCounts() == {0b01: 1, 0b10: 1}
+    assert patient.fork().getGenotypeCounts() == patient.getGenotypeCounts()
+
+
+def testProfiledTrajectory():
+    plain = runPatient(newPatient(100, 5), 0, TIME_STEPS)
+    profiled = newPatient(100, 5, ProfiledTreatedPatient)
+    assert runPatient(profiled, 0, TIME_STEPS) == plain
+    assert profiled.profile.getNumSteps() == TIME_STEPS
+
+
+def testCheckpointAndPickleResume(tmp_path):
+    uninterrupted = runPatient(newPatient(100, 9), 0, TIME_STEPS)
+
+    patient = newPatient(100, 9)
+    first = runPatient(patient, 0, 80)
+    path = tmp_path / 'patient.ckpt'
+    saveCheckpoint(path, patient, 80)
+    restored, timeStep = loadCheckpoint(path)
+    assert first + runPatient(restored, timeStep, TIME_STEPS) == uninterrupted
+
+    unpickled = pickle.loads(pickle.dumps(patient))
+    assert first + runPatient(unpickled, 80, TIME_STEPS) == uninterrupted
+
+
+def testParallelDoesNotDependOnWorkers():
+    results = [parallelSimulationWithDrug(*PARAMS, PRESCRIPTIONS, 6, 60, seed=4, workers=workers)
+               for workers in (1, 2)]
+    assert results[0] == results[1]
+
+
+
+def assertSameMeans(reference, curves):
+    """
+    Checks that two sets of curves of shape (timeSteps, trials) have the same
+    mean at every time step, within 5 standard errors of the difference (plus
+    one particle, for curves that are almost constant).
+    """
+    difference = np.abs(reference.mean(axis=1) - curves.mean(axis=1))
+    stdError = np.sqrt(reference.var(axis=1, ddof=1) / reference.shape[1] + curves.var(axis=1, ddof=1) / curves.shape[1])
+    assert np.all(difference <= 5 * stdError + 1.0), np.max(difference - 5 * stdError)
+
+
+def testEngineMeans():
+    objectCurves = runSimulationWithDrug(*PARAMS, PRESCRIPTIONS, NUM_TRIALS, TIME_STEPS, 'object', seed=0)
+    startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb = PARAMS
+
+    for engine in ('numpy', 'counts'):
+        curves = runSimulationWithDrug(*PARAMS, PRESCRIPTIONS, NUM_TRIALS, TIME_STEPS, engine, seed=1)
+        for reference, engineCurves in zip(objectCurves, curves):
+            assertSameMeans(reference, engineCurves)
+
+    # One cohort patient or one unconnected compartment per trial
+    cohort = Cohort(startPop, np.full(NUM_TRIALS, maxPop), maxBirthProb, clearProb, drugs, mutProb, rng=2)
+    compartments = CompartmentPatient(startPop, np.full(NUM_TRIALS, maxPop), maxBirthProb, clearProb, drugs, mutProb,
+                                      rng=3)
+    for curves in (cohort.run(TIME_STEPS, PRESCRIPTIONS), compartments.run(TIME_STEPS, PRESCRIPTIONS)):
+        for reference, engineCurves in zip(objectCurves, curves):
+            assertSameMeans(reference, engineCurves)
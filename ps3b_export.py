@@ -0,0 +1,361 @@
+# Columnar export of simulation trajectories
+"""
+Writes the trajectories of simulationWithDrug trials to disk in a columnar
+format while the trials run. A trajectory file is a table with one row per
+trial and time step and the columns 'trial', 'timeStep', 'totalPop' and
+'resistPop'. Rows are written in chunks of trials, and the simulation
+parameters are stored in a metadata header.
+
+Genotype counts are optionally written in long form to a second trajectory
+file (see genotypePath): one row per trial, time step and genotype present,
+with the columns 'trial', 'timeStep', 'genotype' (the resistance bitmask, bit
+j standing for resistance to drugs[j]) and 'count'. Its size grows with the
+number of genotypes actually present, not with 2^len(drugs).
+
+Formats:
+
+- 'npz': a zip archive with one compressed .npy entry per column and chunk
+  and a metadata.json entry; columns are read one at a time.
+- 'npy': a directory with one uncompressed .npy file per column, grown chunk
+  by chunk, and metadata.json; columns can be memory-mapped.
+- 'parquet': a Parquet file, one row group per chunk (needs pyarrow).
+- 'arrow': an Arrow IPC file, one record batch per chunk, memory-mappable
+  when uncompressed (needs pyarrow).
+"""
+
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from ps3b import iterTrialWithDrug
+from ps3b_parallel import seedTrial
+
+
+
+FORMATS = ('npz', 'npy', 'parquet', 'arrow')
+EXTENSIONS = {'.npz': 'npz', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+
+def formatOf(path):
+    """
+    Guesses the trajectory format from the extension of path; paths without a
+    known extension are 'npy' directories.
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1], 'npy')
+
+
+def _importPyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('the parquet and arrow formats need the pyarrow package') from None
+    return pyarrow
+
+
+
+class TrajectoryWriter(object):
+    """
+    Chunked writer of a trajectory table. Use it as a context manager, or call
+    close() once every chunk is written.
+    """
+
+    def __init__(self, path, metadata):
+        """
+        path: the file (or directory, for 'npy') to write
+        metadata: run parameters to store in the header (a JSON-serializable
+        dictionary)
+        """
+        self.path = path
+        self.metadata = metadata
+        self.numChunks = 0
+        self.numRows = 0
+
+    def write(self, columns):
+        """
+        Appends a chunk of rows.
+
+        columns: {column name : 1-d numpy array}, the same names and dtypes
+        for every chunk
+        """
+        self._write(columns)
+        self.numChunks += 1
+        self.numRows += len(next(iter(columns.values())))
+
+    def _write(self, columns):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+
+class NpzTrajectoryWriter(TrajectoryWriter):
+    """
+    Writes a zip archive of compressed .npy chunks, named
+    '<column>/<chunk number>.npy'.
+    """
+
+    def __init__(self, path, metadata, compression=zipfile.ZIP_DEFLATED):
+        TrajectoryWriter.__init__(self, path, metadata)
+        self.archive = zipfile.ZipFile(path, 'w', compression=compression)
+        self.archive.writestr('metadata.json', json.dumps(metadata))
+
+    def _write(self, columns):
+        for name, values in columns.items():
+            with self.archive.open(f'{name}/{self.numChunks:06d}.npy', 'w', force_zip64=True) as file:
+                np.lib.format.write_array(file, np.ascontiguousarray(values))
+
+    def close(self):
+        self.archive.close()
+
+
+class NpyTrajectoryWriter(TrajectoryWriter):
+    """
+    Writes one .npy file per column into a directory. Each file starts with a
+    fixed-size header that is rewritten with the final row count on close().
+    """
+    HEADER_SIZE = 128
+
+    def __init__(self, path, metadata):
+        TrajectoryWriter.__init__(self, path, metadata)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'metadata.json'), 'w') as file:
+            json.dump(metadata, file)
+        self.files = {}
+        self.dtypes = {}
+
+    def _header(self, dtype, length):
+        descr = np.lib.format.dtype_to_descr(dtype)
+        text = f"{{'descr': {descr!r}, 'fortran_order': False, 'shape': ({length},), }}"
+        text = text.ljust(self.HEADER_SIZE - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+    def _write(self, columns):
+        for name, values in columns.items():
+            if name not in self.files:
+                self.files[name] = open(os.path.join(self.path, name + '.npy'), 'wb')
+                self.dtypes[name] = values.dtype
+                self.files[name].write(self._header(values.dtype, 0))
+            self.files[name].write(np.ascontiguousarray(values, dtype=self.dtypes[name]).tobytes())
+
+    def close(self):
+        for name, file in self.files.items():
+            file.seek(0)
+            file.write(self._header(self.dtypes[name], self.numRows))
+            file.close()
+        self.files = {}
+
+
+class ParquetTrajectoryWriter(TrajectoryWriter):
+    """
+    Writes a Parquet file with one row group per chunk and the metadata in the
+    schema.
+    """
+
+    def __init__(self, path, metadata, compression='zstd'):
+        TrajectoryWriter.__init__(self, path, metadata)
+        self.pyarrow = _importPyarrow()
+        self.compression = compression
+        self.writer = None
+
+    def _table(self, columns):
+        table = self.pyarrow.table(columns)
+        return table.replace_schema_metadata({'ps3b': json.dumps(self.metadata)})
+
+    def _write(self, columns):
+        table = self._table(columns)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ArrowTrajectoryWriter(ParquetTrajectoryWriter):
+    """
+    Writes an Arrow IPC file with one record batch per chunk. Files written
+    with compression=None can be memory-mapped without copying.
+    """
+
+    def __init__(self, path, metadata, compression=None):
+        ParquetTrajectoryWriter.__init__(self, path, metadata, compression)
+
+    def _write(self, columns):
+        table = self._table(columns)
+        if self.writer is None:
+            options = self.pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = self.pyarrow.ipc.new_file(self.path, table.schema, options=options)
+        self.writer.write_table(table)
+
+
+WRITERS = {
+    'npz'     : NpzTrajectoryWriter,
+    'npy'     : NpyTrajectoryWriter,
+    'parquet' : ParquetTrajectoryWriter,
+    'arrow'   : ArrowTrajectoryWriter,
+}
+
+
+def genotypePath(path):
+    """
+    Returns the path of the genotype file written next to the trajectory file
+    at path: 'run.npz' -> 'run.genotypes.npz', 'run' -> 'run.genotypes'.
+    """
+    root, extension = os.path.splitext(path)
+    if extension not in EXTENSIONS:
+        root, extension = path.rstrip(os.sep), ''
+    return root + '.genotypes' + extension
+
+
+def openTrajectoryWriter(path, metadata, format=None, **options):
+    """
+    Returns a TrajectoryWriter for path, in format (guessed from the extension
+    of path if None). options are passed on to the writer, e.g. compression.
+    """
+    format = format or formatOf(path)
+    if format not in WRITERS:
+        raise ValueError(f'Unknown trajectory format: {format!r}')
+    return WRITERS[format](path, metadata, **options)
+
+
+
+def readTrajectoryMetadata(path, format=None):
+    """
+    Returns the metadata header of a trajectory file.
+    """
+    format = format or formatOf(path)
+    if format == 'npz':
+        with zipfile.ZipFile(path) as archive:
+            return json.loads(archive.read('metadata.json'))
+    if format == 'npy':
+        with open(os.path.join(path, 'metadata.json')) as file:
+            return json.load(file)
+    pyarrow = _importPyarrow()
+    if format == 'parquet':
+        schema = pyarrow.parquet.read_schema(path)
+    else:
+        with pyarrow.memory_map(path) as source:
+            schema = pyarrow.ipc.open_file(source).schema
+    return json.loads(schema.metadata[b'ps3b'])
+
+
+def readTrajectories(path, columns=None, format=None):
+    """
+    Reads columns of a trajectory file without loading the others.
+
+    columns: names of the columns to read (None for all of them)
+
+    returns: {column name : numpy array}; 'npy' columns are read-only memory
+    maps and uncompressed 'arrow' columns are views of a memory-mapped file
+    """
+    format = format or formatOf(path)
+    if format == 'npz':
+        chunks = {}
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                column = os.path.dirname(name)
+                if column and (columns is None or column in columns):
+                    with archive.open(name) as file:
+                        chunks.setdefault(column, []).append(np.lib.format.read_array(file))
+        return {column: np.concatenate(parts) for column, parts in chunks.items()}
+    if format == 'npy':
+        if columns is None:
+            columns = [name[:-4] for name in sorted(os.listdir(path)) if name.endswith('.npy')]
+        return {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r') for column in columns}
+    pyarrow = _importPyarrow()
+    if format == 'parquet':
+        table = pyarrow.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+
+def exportSimulationWithDrug(path, startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100, engine='object', seed=None, genotypes=False, chunkTrials=10, format=None, **options):
+    """
+    Runs the trials of simulationWithDrug and writes their trajectories to
+    path as they run, chunkTrials trials per chunk.
+
+    seed: seed of the trial streams, as for ps3b_parallel.runTrials
+
+    genotypes: whether to also write the genotype counts, in long form, to
+    genotypePath(path) (at most 64 drugs)
+
+    format, options: see openTrajectoryWriter
+
+    returns: the number of rows written to path (an integer)
+    """
+    if genotypes and len(drugs) > 64:
+        raise ValueError('genotype export supports at most 64 drugs')
+    metadata = {
+        'startPop'            : startPop,
+        'maxPop'              : maxPop,
+        'maxBirthProb'        : maxBirthProb,
+        'clearProb'           : clearProb,
+        'drugs'               : list(drugs),
+        'mutProb'             : mutProb,
+        'timelyPrescriptions' : {str(timeStep): newDrugs for timeStep, newDrugs in timelyPrescriptions.items()},
+        'numTrials'           : numTrials,
+        'timeSteps'           : timeSteps,
+        'engine'              : engine,
+        'seed'                : seed,
+    }
+    popType = np.float64 if engine == 'ode' else np.int64
+    seedSequences = np.random.SeedSequence(seed).spawn(numTrials)
+
+    with openTrajectoryWriter(path, metadata, format, **options) as writer:
+        genotypeWriter = None
+        if genotypes:
+            genotypeWriter = openTrajectoryWriter(genotypePath(path), metadata, format, **options)
+        try:
+            for firstTrial in range(0, numTrials, chunkTrials):
+                trials = range(firstTrial, min(firstTrial + chunkTrials, numTrials))
+                rows = len(trials) * timeSteps
+                chunk = {
+                    'trial'     : np.repeat(np.arange(trials.start, trials.stop, dtype=np.int32), timeSteps),
+                    'timeStep'  : np.tile(np.arange(timeSteps, dtype=np.int32), len(trials)),
+                    'totalPop'  : np.empty(rows, dtype=popType),
+                    'resistPop' : np.empty(rows, dtype=popType),
+                }
+                genotypeRows = {'trial': [], 'timeStep': [], 'genotype': [], 'count': []}
+
+                row = 0
+                for trial in trials:
+                    for timeStep, totalPop, resistPop, *genotypeCounts in iterTrialWithDrug(
+                            startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions,
+                            timeSteps, engine, seedTrial(seedSequences[trial]), genotypes=genotypes):
+                        chunk['totalPop'][row] = totalPop
+                        chunk['resistPop'][row] = resistPop
+                        if genotypes:
+                            for mask, count in genotypeCounts[0].items():
+                                genotypeRows['trial'].append(trial)
+                                genotypeRows['timeStep'].append(timeStep)
+                                genotypeRows['genotype'].append(mask)
+                                genotypeRows['count'].append(count)
+                        row += 1
+
+                writer.write(chunk)
+                if genotypes:
+                    genotypeWriter.write({
+                        'trial'    : np.array(genotypeRows['trial'], dtype=np.int32),
+                        'timeStep' : np.array(genotypeRows['timeStep'], dtype=np.int32),
+                        'genotype' : np.array(genotypeRows['genotype'], dtype=np.uint64),
+                        'count'    : np.array(genotypeRows['count'], dtype=popType),
+                    })
+        finally:
+            if genotypeWriter is not None:
+                genotypeWriter.close()
+        return writer.numRows
@@ -0,0 +1,71 @@
+# Checks of the trajectory export, run with pytest
+"""
+Checks of ps3b_export: trajectories and genotype counts written in each
+format read back unchanged, with their metadata.
+"""
+
+import numpy as np
+import pytest
+
+from ps3b import runTrialWithDrug
+from ps3b_export import FORMATS, exportSimulationWithDrug, genotypePath, readTrajectories, readTrajectoryMetadata
+from ps3b_parallel import seedTrial
+
+
+
+PARAMS = (50, 500, 0.1, 0.05, ['A', 'B'], 0.005, {20: 'A'})
+NUM_TRIALS = 3
+TIME_STEPS = 40
+PATHS = {'npz': 'run.npz', 'npy': 'run', 'parquet': 'run.parquet', 'arrow': 'run.arrow'}
+
+
+def export(directory, format):
+    path = str(directory / PATHS[format])
+    rows = exportSimulationWithDrug(path, *PARAMS, NUM_TRIALS, TIME_STEPS, 'counts', seed=6, genotypes=True,
+                                    chunkTrials=2)
+    assert rows == NUM_TRIALS * TIME_STEPS
+    return path
+
+
+@pytest.mark.parametrize('format', FORMATS)
+def testRoundTrip(tmp_path, format):
+    if format in ('parquet', 'arrow'):
+        pytest.importorskip('pyarrow')
+    path = export(tmp_path, format)
+    reference = path
+    if format != 'npz':
+        (tmp_path / 'reference').mkdir()
+        reference = export(tmp_path / 'reference', 'npz')
+
+    metadata = readTrajectoryMetadata(path)
+    assert metadata == readTrajectoryMetadata(reference)
+    assert metadata['drugs'] == ['A', 'B'] and metadata['timelyPrescriptions'] == {'20': 'A'}
+
+    trajectories = readTrajectories(path)
+    assert set(trajectories) == {'trial', 'timeStep', 'totalPop', 'resistPop'}
+    for column, values in readTrajectories(reference).items():
+        assert np.array_equal(trajectories[column], values)
+    assert np.array_equal(readTrajectories(path, ['timeStep'])['timeStep'], trajectories['timeStep'])
+    # Trial i follows the i-th stream spawned from the seed
+    for trial, seedSequence in enumerate(np.random.SeedSequence(6).spawn(NUM_TRIALS)):
+        totalPop, resistPop = runTrialWithDrug(*PARAMS, TIME_STEPS, 'counts', seedTrial(seedSequence))
+        assert np.array_equal(trajectories['totalPop'][trajectories['trial'] == trial], totalPop)
+        assert np.array_equal(trajectories['resistPop'][trajectories['trial'] == trial], resistPop)
+
+    genotypes = readTrajectories(genotypePath(path))
+    assert readTrajectoryMetadata(genotypePath(path)) == metadata
+    for column, values in readTrajectories(genotypePath(reference)).items():
+        assert np.array_equal(genotypes[column], values)
+
+    # The genotype counts of each trial and time step add up to the total
+    rows = genotypes['trial'] * TIME_STEPS + genotypes['timeStep']
+    totals = np.bincount(rows, weights=genotypes['count'], minlength=NUM_TRIALS * TIME_STEPS)
+    assert np.array_equal(totals, trajectories['totalPop'])
+    assert np.all(genotypes['genotype'] < 4)
+
+
+def testGenotypePath():
+    assert genotypePath('run.npz') == 'run.genotypes.npz'
+    assert genotypePath('run.parquet') == 'run.genotypes.parquet'
+    assert genotypePath('runs/run') == 'runs/run.genotypes'
+    assert genotypePath('runs/run/') == 'runs/run.genotypes'
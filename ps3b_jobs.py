@@ -0,0 +1,351 @@
+# Asynchronous job service for simulationWithDrug scenarios
+"""
+Runs simulationWithDrug scenarios as background jobs on one machine. A
+JobService accepts parameter sets (see ps3b_sweep.DEFAULT_PARAMS) from any
+number of asyncio clients and answers at once with a job id; the trials of the
+job then run in chunks on a shared process pool, so the event loop stays free
+to serve other clients. Clients poll the status of a job or stream its
+progress (completed trials) and await or cancel it.
+
+At most maxJobs jobs run at a time, the others wait in a queue. Submitting a
+parameter set identical to a queued or running job (same canonical
+parameters, seed included) returns the id of that job instead of simulating
+it twice; the job is only cancelled once every submitter has cancelled it.
+With a ps3b_sweep.ResultCache, seeded scenarios simulated before are answered
+from the cache. The service keeps the status and result of the last
+keepFinished finished jobs; older ones are forgotten.
+
+Run as a script to serve jobs over TCP, one JSON object per line:
+
+    {"op": "submit", "params": {...}}   ->  {"jobId": ...}
+    {"op": "status", "jobId": ...}      ->  status (see Job.getStatus)
+    {"op": "stream", "jobId": ...}      ->  one status line per progress update
+    {"op": "result", "jobId": ...}      ->  {"totalPop": [...], "resistPop": [...]}
+    {"op": "cancel", "jobId": ...}      ->  {"cancelled": true or false}
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ps3b import runTrialWithDrug
+from ps3b_parallel import splitTrials, sumChunk
+from ps3b_sweep import canonicalParams, paramsKey
+
+
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """
+    JobCancelled is raised by JobService.result() when the awaited job was
+    cancelled.
+    """
+
+
+class Job(object):
+    """
+    A submitted simulationWithDrug scenario and its progress.
+    """
+
+    def __init__(self, jobId, key, params):
+        self.jobId = jobId
+        self.key = key
+        self.params = params
+        self.state = QUEUED
+        self.completedTrials = 0
+        self.submitters = 1
+        self.result = None
+        self.error = None
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def _notify(self):
+        """
+        Wakes up the clients streaming this job.
+        """
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def isFinished(self):
+        return self.state in FINISHED
+
+    def getStatus(self):
+        """
+        Returns the status of the job: a dictionary with its 'jobId', 'state'
+        (queued, running, done, failed or cancelled), 'completedTrials',
+        'numTrials' and, for failed jobs, 'error'.
+        """
+        status = {
+            'jobId'           : self.jobId,
+            'state'           : self.state,
+            'completedTrials' : self.completedTrials,
+            'numTrials'       : self.params['numTrials'],
+        }
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+
+
+class JobService(object):
+    """
+    Queue of simulationWithDrug jobs run on a process pool. Create and use it
+    inside a running event loop, as an async context manager or followed by a
+    call to close().
+    """
+
+    def __init__(self, maxJobs=4, workers=None, chunkSize=None, cache=None, keepFinished=1000):
+        """
+        maxJobs: number of jobs running at the same time (an integer)
+
+        workers: number of worker processes (an integer, None for one per CPU)
+
+        chunkSize: number of trials sent to a worker at once, which is also
+        the granularity of progress and cancellation (None for about four
+        chunks per worker)
+
+        cache: a ps3b_sweep.ResultCache for the results of seeded jobs
+        (optional)
+
+        keepFinished: number of finished jobs whose status and result are
+        kept; the oldest finished job is dropped when another one finishes
+        beyond that (an integer)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.chunkSize = chunkSize
+        self.cache = cache
+        self.slots = asyncio.Semaphore(maxJobs)
+        self.jobs = {}
+        self.inFlight = {}
+        self.keepFinished = keepFinished
+        self.finished = collections.deque()
+
+    async def submit(self, **params):
+        """
+        Submits a scenario.
+
+        params: keyword parameters of simulationWithDrug plus seed, see
+        ps3b_sweep.DEFAULT_PARAMS
+
+        returns: the job id (a string), the id of the identical queued or
+        running job if there is one
+        """
+        params = canonicalParams(params)
+        key = paramsKey(params)
+        job = self.inFlight.get(key)
+        if job is not None:
+            job.submitters += 1
+            return job.jobId
+
+        job = Job(uuid.uuid4().hex, key, params)
+        self.jobs[job.jobId] = job
+        curves = None if self.cache is None or params['seed'] is None else self.cache.get(key)
+        if curves is not None:
+            job.completedTrials = params['numTrials']
+            self._finish(job, DONE, result=curves)
+        else:
+            self.inFlight[key] = job
+            job.task = asyncio.create_task(self._run(job))
+        return job.jobId
+
+    def _getJob(self, jobId):
+        if jobId not in self.jobs:
+            raise KeyError(f'Unknown job: {jobId!r}')
+        return self.jobs[jobId]
+
+    def getStatus(self, jobId):
+        """
+        Returns the status of a job, see Job.getStatus.
+        """
+        return self._getJob(jobId).getStatus()
+
+    async def stream(self, jobId):
+        """
+        Yields the status of a job now and after every progress update, until
+        the job is finished.
+        """
+        job = self._getJob(jobId)
+        while True:
+            changed = job.changed
+            yield job.getStatus()
+            if job.isFinished():
+                return
+            await changed.wait()
+
+    async def result(self, jobId):
+        """
+        Waits for a job to finish.
+
+        returns: a tuple (average total population, average resistant
+        population) of numpy arrays, one value per time step
+
+        raises: JobCancelled if the job was cancelled, RuntimeError if it
+        failed
+        """
+        job = self._getJob(jobId)
+        async for status in self.stream(jobId):
+            pass
+        if job.state == CANCELLED:
+            raise JobCancelled(f'job {jobId} was cancelled')
+        if job.state == FAILED:
+            raise RuntimeError(f'job {jobId} failed: {job.error}')
+        return job.result
+
+    def cancel(self, jobId):
+        """
+        Withdraws one submission of a job. The job is cancelled once all its
+        submitters have cancelled it; trials already running on a worker
+        finish, but their results are dropped.
+
+        returns: True if the job is now cancelled, False if it is finished or
+        other submitters still wait for it
+        """
+        job = self._getJob(jobId)
+        if job.isFinished():
+            return False
+        job.submitters -= 1
+        if job.submitters > 0:
+            return False
+        job.task.cancel()
+        self._finish(job, CANCELLED)
+        return True
+
+    def _finish(self, job, state, result=None, error=None):
+        job.state = state
+        job.result = result
+        job.error = error
+        if self.inFlight.get(job.key) is job:
+            del self.inFlight[job.key]
+        self.finished.append(job.jobId)
+        while len(self.finished) > self.keepFinished:
+            del self.jobs[self.finished.popleft()]
+        job._notify()
+
+    async def _run(self, job):
+        """
+        Runs the trials of a job in chunks on the process pool, once one of
+        the maxJobs slots is free.
+        """
+        params = job.params
+        trialArgs = (params['startPop'], params['maxPop'], params['maxBirthProb'], params['clearProb'],
+                     params['drugs'], params['mutProb'], params['timelyPrescriptions'], params['timeSteps'],
+                     params['engine'])
+        loop = asyncio.get_running_loop()
+        futures = []
+        try:
+            async with self.slots:
+                job.state = RUNNING
+                job._notify()
+                workers, chunks = splitTrials(params['numTrials'], params['seed'], self.workers, self.chunkSize)
+
+                async def runChunk(chunk):
+                    sums = await loop.run_in_executor(self.executor, sumChunk, runTrialWithDrug, trialArgs, chunk)
+                    return len(chunk), sums
+
+                futures = [asyncio.ensure_future(runChunk(chunk)) for chunk in chunks]
+                sums = None
+                for future in asyncio.as_completed(futures):
+                    numTrials, chunkSums = await future
+                    chunkSums = np.array(chunkSums, dtype=np.float64)
+                    sums = chunkSums if sums is None else sums + chunkSums
+                    job.completedTrials += numTrials
+                    job._notify()
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        except Exception as error:
+            self._finish(job, FAILED, error=f'{type(error).__name__}: {error}')
+            return
+
+        curves = tuple(sums / params['numTrials'])
+        if self.cache is not None and params['seed'] is not None:
+            self.cache.put(job.key, curves)
+        self._finish(job, DONE, result=curves)
+
+    async def close(self):
+        """
+        Cancels the unfinished jobs and shuts the process pool down.
+        """
+        for job in list(self.inFlight.values()):
+            job.submitters = 1
+            self.cancel(job.jobId)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excInfo):
+        await self.close()
+
+
+
+async def _handleClient(service, reader, writer):
+    """
+    Answers the requests of one TCP client, see the module documentation.
+    """
+    async def send(message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'submit':
+                    await send({'jobId': await service.submit(**request.get('params', {}))})
+                elif op == 'status':
+                    await send(service.getStatus(request['jobId']))
+                elif op == 'stream':
+                    async for status in service.stream(request['jobId']):
+                        await send(status)
+                elif op == 'result':
+                    totalPop, resistPop = await service.result(request['jobId'])
+                    await send({'totalPop': totalPop.tolist(), 'resistPop': resistPop.tolist()})
+                elif op == 'cancel':
+                    await send({'cancelled': service.cancel(request['jobId'])})
+                else:
+                    await send({'error': f'Unknown operation: {op!r}'})
+            except (ValueError, KeyError, TypeError, RuntimeError, JobCancelled) as error:
+                await send({'error': f'{type(error).__name__}: {error}'})
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=8765, **options):
+    """
+    Serves a JobService over TCP until cancelled.
+
+    options: keyword arguments of JobService
+    """
+    async with JobService(**options) as service:
+        server = await asyncio.start_server(lambda reader, writer: _handleClient(service, reader, writer), host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Job service for simulationWithDrug scenarios.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--jobs', type=int, default=4, help='number of jobs running at the same time')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--keep', type=int, default=1000, help='number of finished jobs kept')
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port, maxJobs=args.jobs, workers=args.workers, keepFinished=args.keep))
+
+
+
+if __name__ == '__main__':
+    main()
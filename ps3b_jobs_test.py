@@ -0,0 +1,84 @@
+# Checks of the job service, run with pytest
+"""
+Checks of ps3b_jobs.JobService: identical submissions share one job, which is
+only cancelled once every submitter has cancelled it, cached results finish
+at once with all their trials done, and only the last keepFinished finished
+jobs are kept.
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from ps3b_jobs import CANCELLED, DONE, JobCancelled, JobService
+from ps3b_sweep import ResultCache, paramsKey
+
+
+
+PARAMS = {'startPop': 20, 'maxPop': 200, 'drugs': ['A'], 'timelyPrescriptions': {10: 'A'}, 'numTrials': 4,
+          'timeSteps': 20, 'seed': 3}
+
+
+def testDuplicateSubmissionsShareOneJob():
+    async def run():
+        async with JobService(maxJobs=1, workers=1) as service:
+            first = await service.submit(**PARAMS)
+            second = await service.submit(**dict(PARAMS, timelyPrescriptions={'10': ['A']}))
+            other = await service.submit(**dict(PARAMS, seed=4))
+            assert first == second != other
+            totalPop, resistPop = await service.result(first)
+            assert len(totalPop) == PARAMS['timeSteps']
+            assert service.getStatus(first)['completedTrials'] == PARAMS['numTrials']
+
+    asyncio.run(run())
+
+
+def testCancelledOnceEverySubmitterCancels():
+    async def run():
+        async with JobService(maxJobs=1, workers=1) as service:
+            # The first job holds the only slot, so the second stays queued
+            await service.submit(**dict(PARAMS, seed=5))
+            jobId = await service.submit(**PARAMS)
+            await service.submit(**PARAMS)
+            assert not service.cancel(jobId)
+            assert service.getStatus(jobId)['state'] != CANCELLED
+            assert service.cancel(jobId)
+            assert service.getStatus(jobId)['state'] == CANCELLED
+            with pytest.raises(JobCancelled):
+                await service.result(jobId)
+            # A new submission starts a new job
+            assert await service.submit(**PARAMS) != jobId
+
+    asyncio.run(run())
+
+
+def testCacheHitFinishesAtOnce(tmp_path):
+    cache = ResultCache(tmp_path)
+    curves = (np.arange(20.0), np.zeros(20))
+    cache.put(paramsKey(PARAMS), curves)
+
+    async def run():
+        async with JobService(workers=1, cache=cache) as service:
+            jobId = await service.submit(**PARAMS)
+            status = service.getStatus(jobId)
+            assert status['state'] == DONE
+            assert status['completedTrials'] == status['numTrials'] == PARAMS['numTrials']
+            totalPop, resistPop = await service.result(jobId)
+            assert np.array_equal(totalPop, curves[0])
+
+    asyncio.run(run())
+
+
+def testOldestFinishedJobsAreDropped():
+    async def run():
+        async with JobService(workers=1, keepFinished=2) as service:
+            jobIds = []
+            for seed in range(3):
+                jobIds.append(await service.submit(**dict(PARAMS, seed=seed, numTrials=1)))
+                await service.result(jobIds[-1])
+            with pytest.raises(KeyError):
+                service.getStatus(jobIds[0])
+            assert [service.getStatus(jobId)['state'] for jobId in jobIds[1:]] == [DONE, DONE]
+
+    asyncio.run(run())
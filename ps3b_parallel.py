@@ -0,0 +1,187 @@
+# Multiprocess trial runner for the virus population simulation
+"""
+Runs independent trials of the simulation on a pool of worker processes and
+averages their population curves. Every trial gets its own random stream
+spawned from one numpy SeedSequence, so for a given seed the averaged curves
+are the same whatever the number of workers. Trials are handed out in chunks,
+and the per-timestep sums of a chunk are added to the totals as soon as its
+worker finishes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from ps3b import runTrialWithoutDrug, runTrialWithDrug
+
+
+
+def seedTrial(seedSequence):
+    """
+    Prepares the random stream of one trial from its seed sequence: returns a
+    numpy Generator, which the engines draw from (the 'object' engine through
+    a ps3b_rng.BlockRandom). The random module is left alone, so running
+    trials does not change the random state of the caller.
+    """
+    return np.random.default_rng(seedSequence)
+
+
+def runTrial(trialFunction, trialArgs, seedSequence):
+    """
+    Runs one trial with its random stream taken from seedSequence and returns
+    the curves returned by trialFunction.
+    """
+    return trialFunction(*trialArgs, rng=seedTrial(seedSequence))
+
+
+def sumChunk(trialFunction, trialArgs, seedSequences):
+    """
+    Runs one trial per seed sequence and returns the per-timestep sums of the
+    curves returned by trialFunction (a list of lists). Module level, so that
+    it can run on worker processes.
+    """
+    sums = None
+    for seedSequence in seedSequences:
+        curves = runTrial(trialFunction, trialArgs, seedSequence)
+        if sums is None:
+            sums = [list(curve) for curve in curves]
+        else:
+            for curveSums, curve in zip(sums, curves):
+                for timeStep, population in enumerate(curve):
+                    curveSums[timeStep] += population
+    return sums
+
+
+def _collectChunk(trialFunction, trialArgs, seedSequences):
+    """
+    Runs one trial per seed sequence and returns the curves returned by
+    trialFunction as a numpy array of shape (curves, timeSteps, trials).
+    """
+    curves = [runTrial(trialFunction, trialArgs, seedSequence) for seedSequence in seedSequences]
+    return np.array(curves).transpose(1, 2, 0)
+
+
+def splitTrials(numTrials, seed, workers, chunkSize):
+    """
+    Spawns one seed sequence per trial and splits them in chunks, as
+    runTrials does; with sumChunk, other schedulers (see ps3b_jobs) run the
+    same trials as runTrials.
+
+    seed, workers, chunkSize: see runTrials
+
+    returns: a tuple (number of workers to use, list of chunks of seed
+    sequences)
+    """
+    if numTrials < 1:
+        raise ValueError('numTrials must be at least 1')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunkSize is None:
+        chunkSize = max(1, -(-numTrials // (4 * workers)))
+
+    seedSequences = np.random.SeedSequence(seed).spawn(numTrials)
+    return workers, [seedSequences[i:i + chunkSize] for i in range(0, numTrials, chunkSize)]
+
+
+def _mapChunks(chunkFunction, trialFunction, trialArgs, chunks, workers):
+    """
+    Calls chunkFunction on every chunk, on a process pool unless workers is 1,
+    and yields (chunk index, result) pairs as the chunks finish.
+    """
+    if workers == 1:
+        for index, chunk in enumerate(chunks):
+            yield index, chunkFunction(trialFunction, trialArgs, chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            futures = {executor.submit(chunkFunction, trialFunction, trialArgs, chunk): index
+                       for index, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+def runTrials(trialFunction, trialArgs, numTrials, seed=None, workers=None, chunkSize=None):
+    """
+    Runs numTrials independent trials and averages their curves.
+
+    trialFunction: a module level function called as
+    trialFunction(*trialArgs, rng=rng) that returns a tuple of curves (lists of
+    populations, one per time step)
+
+    trialArgs: positional arguments of trialFunction (a tuple)
+
+    numTrials: number of trials to run (an integer)
+
+    seed: entropy of the SeedSequence the trial streams are spawned from (an
+    integer, or None for fresh entropy)
+
+    workers: number of worker processes (an integer, None for one per CPU);
+    with 1 worker the trials run in this process
+
+    chunkSize: number of trials sent to a worker at once (an integer, None to
+    give each worker about four chunks)
+
+    returns: a tuple with the average of each curve over the trials (lists of
+    floats)
+    """
+    workers, chunks = splitTrials(numTrials, seed, workers, chunkSize)
+
+    sums = None
+    for index, chunkSums in _mapChunks(sumChunk, trialFunction, trialArgs, chunks, workers):
+        if sums is None:
+            sums = chunkSums
+        else:
+            for curveSums, curve in zip(sums, chunkSums):
+                for timeStep, population in enumerate(curve):
+                    curveSums[timeStep] += population
+
+    return tuple([popSum / numTrials for popSum in curveSums] for curveSums in sums)
+
+
+def collectTrials(trialFunction, trialArgs, numTrials, seed=None, workers=None, chunkSize=None):
+    """
+    Runs numTrials independent trials like runTrials, but keeps the curve of
+    every trial instead of averaging them.
+
+    returns: a tuple with one numpy array of shape (timeSteps, numTrials) per
+    curve returned by trialFunction; column i holds trial i, whatever the
+    number of workers
+    """
+    workers, chunks = splitTrials(numTrials, seed, workers, chunkSize)
+
+    results = [None] * len(chunks)
+    for index, chunkCurves in _mapChunks(_collectChunk, trialFunction, trialArgs, chunks, workers):
+        results[index] = chunkCurves
+
+    return tuple(np.concatenate(results, axis=2))
+
+
+def trialWithoutDrug(*trialArgs, rng=None):
+    """
+    Adapter for runTrials/collectTrials: runs runTrialWithoutDrug and returns
+    its curve in a one-element tuple.
+    """
+    return (runTrialWithoutDrug(*trialArgs, rng=rng),)
+
+
+def parallelSimulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb, numTrials, timeSteps=3000, engine='object', seed=None, workers=None):
+    """
+    Runs the trials of simulationWithoutDrug on a process pool.
+
+    returns: the average virus population after each time step (a list of
+    floats)
+    """
+    trialArgs = (numViruses, maxPop, maxBirthProb, clearProb, timeSteps, engine)
+    popAverage, = runTrials(trialWithoutDrug, trialArgs, numTrials, seed, workers)
+    return popAverage
+
+
+def parallelSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=10, timeSteps=100, engine='object', seed=None, workers=None):
+    """
+    Runs the trials of simulationWithDrug on a process pool.
+
+    returns: a tuple (average total population, average resistant population)
+    of lists of floats, one per time step
+    """
+    trialArgs = (startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions, timeSteps, engine)
+    return runTrials(runTrialWithDrug, trialArgs, numTrials, seed, workers)
@@ -0,0 +1,80 @@
+# Plotting for the virus population simulation
+"""
+Plots of the averaged population curves. This is the only module that needs
+matplotlib; ps3b imports it lazily, and only when a simulation is asked to
+plot, so the simulation core can run on machines without matplotlib.
+"""
+
+import pylab
+
+
+
+def plotSimulationWithoutDrug(popAverage, maxPop):
+    """
+    Plots the average virus population of simulationWithoutDrug.
+
+    popAverage: the average population after each time step (a list of floats)
+    maxPop: maximum virus population for patient (an integer)
+    """
+    timeSteps = len(popAverage)
+    pylab.figure('Average population on different times')
+    pylab.plot([i for i in range(timeSteps)], popAverage, label='average population')
+    pylab.title('Average population on different times')
+    pylab.xlabel('time')
+    pylab.ylabel('population')
+    pylab.xlim(0, timeSteps-1)
+    pylab.ylim(0, maxPop)
+    pylab.show()
+
+
+def plotSimulationWithDrug(total_pop_averages, resist_pop_averages, maxPop, timelyPrescriptions):
+    """
+    Plots the average total and drug-resistant virus populations of
+    simulationWithDrug.
+
+    total_pop_averages, resist_pop_averages: the average populations after each
+    time step (lists of floats)
+    maxPop: maximum virus population for patient (an integer)
+    timelyPrescriptions: {timeStep : drug prescribed at that time step}
+    """
+    timeSteps = len(total_pop_averages)
+    pylab.figure('Medicated Simulation')
+    pylab.title('Medicated Simulation')
+    pylab.plot([i for i in range(timeSteps)], total_pop_averages, label = 'All viruses', color='grey')
+    pylab.plot([i for i in range(timeSteps)], resist_pop_averages, label = 'Drug-resistant viruses', color='yellow')
+    pylab.axhline(y=maxPop, label='Max possible population', color='black')
+    for timeStep in timelyPrescriptions:
+        pylab.axvline(x=timeStep,  label=f'"{timelyPrescriptions[timeStep]}" prescribed')
+    pylab.xlabel('Time steps')
+    pylab.ylabel('Average population')
+    pylab.legend()
+    pylab.show()
+
+
+def plotSimulationWithDrugV2(avg_total_pop, avg_resist_pop, maxPop, timelyPrescriptions):
+    """
+    Plots the average total and drug-resistant virus populations of
+    simulationWithDrugV2 in ps3b_test.
+
+    avg_total_pop, avg_resist_pop: the average populations after each time
+    step (sequences of floats)
+    maxPop: maximum virus population for patient (an integer)
+    timelyPrescriptions: {timeStep : list of drugs prescribed at that time step}
+    """
+    pylab.figure('Virus population simulation')
+    pylab.xlabel('Time steps')
+    pylab.ylabel('Average populaton')
+
+    pylab.plot(avg_total_pop, label='All viruses')
+    pylab.plot(avg_resist_pop, label='Drug-resistant viruses')
+
+    # Separating lines that indicate introduction of certain drugs
+    for timeStep in timelyPrescriptions:
+        addedDrugs = [drug for drug in timelyPrescriptions[timeStep]]
+        pylab.axvline(x=timeStep, label=f'Prescribed drugs: {", ".join(addedDrugs)}', color='red')
+
+    # Show population limit
+    pylab.axhline(y=maxPop, label='Maximum population', color='black')
+
+    pylab.legend()
+    pylab.show()
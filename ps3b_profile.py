@@ -0,0 +1,245 @@
+# Per-phase instrumentation of TreatedPatient.update
+"""
+Opt-in profiling of the object engine. ProfiledTreatedPatient is a
+TreatedPatient whose update() times each of its phases separately and counts
+what happened in the step:
+
+- phases: 'clearance', 'density', 'reproduction' (the resistance check and
+  birth draw of every particle), 'mutation' (drawing the resistances of the
+  offspring) and 'getResistPop'
+- counters: 'particles' (population at the start of the step), 'deaths',
+  'births' and 'mutations' (resistance traits switched in offspring)
+
+The measurements go into a PhaseProfile, which gives a per-run report and can
+be exported as folded stacks for flame graph tools (flamegraph.pl,
+speedscope, inferno). Plain TreatedPatient is not instrumented at all, so
+profiling costs nothing unless a ProfiledTreatedPatient is used. The profiled
+patient wraps the phase methods of TreatedPatient.update() instead of copying
+it, so a profiled trial draws the same random numbers and follows the same
+trajectory.
+
+Run as a script to print the profile of a sample simulation.
+"""
+
+import time
+
+import numpy as np
+
+from ps3b import TreatedPatient, makeTreatedPatient, prescribe
+from ps3b_parallel import seedTrial
+
+
+
+PHASES = ('clearance', 'density', 'reproduction', 'mutation', 'getResistPop')
+COUNTERS = ('particles', 'deaths', 'births', 'mutations')
+
+
+class PhaseProfile(object):
+    """
+    Per-step phase times (in seconds) and counters of profiled updates. Each
+    call to ProfiledTreatedPatient.update() starts a new step; getResistPop()
+    calls are added to the current step.
+    """
+
+    def __init__(self):
+        self.seconds = {phase: [] for phase in PHASES}
+        self.counts = {counter: [] for counter in COUNTERS}
+
+    def getNumSteps(self):
+        """
+        Returns the number of profiled steps.
+        """
+        return len(self.counts['particles'])
+
+    def startStep(self, particles):
+        """
+        Starts the record of a new step of a population of particles.
+        """
+        for values in self.seconds.values():
+            values.append(0.0)
+        for values in self.counts.values():
+            values.append(0)
+        self.counts['particles'][-1] = particles
+
+    def addTime(self, phase, seconds):
+        """
+        Adds seconds to the time of phase in the current step.
+        """
+        self.seconds[phase][-1] += seconds
+
+    def addCount(self, counter, count):
+        """
+        Adds count to counter in the current step.
+        """
+        self.counts[counter][-1] += count
+
+    def report(self):
+        """
+        Returns the profile as a dictionary:
+
+        'steps': the number of profiled steps
+        'seconds': the total time of all phases
+        'phases': {phase : {'seconds': total time, 'fraction': share of the
+        total time, 'perStep': mean time per step, 'perParticle': mean time
+        per particle and step}}
+        'counts': {counter : total over all steps}
+        'perStep': {phase or counter : array with one value per step}
+        """
+        steps = self.getNumSteps()
+        particles = max(1, sum(self.counts['particles']))
+        total = sum(sum(values) for values in self.seconds.values())
+        phases = {}
+        for phase, values in self.seconds.items():
+            seconds = sum(values)
+            phases[phase] = {
+                'seconds'     : seconds,
+                'fraction'    : seconds / total if total else 0.0,
+                'perStep'     : seconds / steps if steps else 0.0,
+                'perParticle' : seconds / particles,
+            }
+        perStep = {phase: np.array(values) for phase, values in self.seconds.items()}
+        perStep.update((counter, np.array(values, dtype=np.int64)) for counter, values in self.counts.items())
+        return {
+            'steps'   : steps,
+            'seconds' : total,
+            'phases'  : phases,
+            'counts'  : {counter: sum(values) for counter, values in self.counts.items()},
+            'perStep' : perStep,
+        }
+
+    def formatReport(self):
+        """
+        Returns the report as a printable table.
+        """
+        report = self.report()
+        lines = [f'{"phase":<14}{"seconds":>10}{"share":>8}{"us/step":>11}{"ns/particle":>13}']
+        for phase, entry in report['phases'].items():
+            lines.append(f'{phase:<14}{entry["seconds"]:10.4f}{entry["fraction"]:8.1%}'
+                         f'{entry["perStep"] * 1e6:11.1f}{entry["perParticle"] * 1e9:13.1f}')
+        lines.append(f'{report["steps"]} steps, ' +
+                     ', '.join(f'{count} {counter}' for counter, count in report['counts'].items()))
+        return '\n'.join(lines)
+
+    def foldedStacks(self):
+        """
+        Returns the phase times in the folded stack format of flame graph
+        tools: one 'step;update;<phase> <microseconds>' line per update phase
+        and a 'step;getResistPop <microseconds>' line.
+        """
+        lines = []
+        for phase, values in self.seconds.items():
+            stack = 'step;getResistPop' if phase == 'getResistPop' else 'step;update;' + phase
+            lines.append(f'{stack} {round(sum(values) * 1e6)}')
+        return '\n'.join(lines) + '\n'
+
+    def writeFoldedStacks(self, path):
+        """
+        Writes foldedStacks() to the file at path.
+        """
+        with open(path, 'w') as file:
+            file.write(self.foldedStacks())
+
+
+
+class ProfiledTreatedPatient(TreatedPatient):
+    """
+    TreatedPatient recording the time and counts of each phase of update()
+    and of getResistPop() in a PhaseProfile.
+    """
+
+    def __init__(self, viruses, maxPop, rng=None, profile=None):
+        """
+        Initialization function, see TreatedPatient.
+
+        profile: the PhaseProfile to record into (a new one if None)
+        """
+        TreatedPatient.__init__(self, viruses, maxPop, rng)
+        self.profile = PhaseProfile() if profile is None else profile
+
+    @classmethod
+    def fromPatient(cls, patient, profile=None):
+        """
+        Returns a profiled copy of a TreatedPatient, see TreatedPatient.fork.
+        """
+        profiled = patient.fork()
+        profiled.__class__ = cls
+        profiled.profile = PhaseProfile() if profile is None else profile
+        return profiled
+
+    def getResistPop(self, drugResist):
+        start = time.perf_counter()
+        resistPop = TreatedPatient.getResistPop(self, drugResist)
+        if self.profile.getNumSteps():
+            self.profile.addTime('getResistPop', time.perf_counter() - start)
+        return resistPop
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, like TreatedPatient.update(), and records the step in the
+        profile.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        self.profile.startStep(self.getTotalPop())
+        return TreatedPatient.update(self)
+
+    def _clearViruses(self, rng):
+        start = time.perf_counter()
+        numViruses = len(self.viruses)
+        TreatedPatient._clearViruses(self, rng)
+        self.profile.addCount('deaths', numViruses - len(self.viruses))
+        self.profile.addTime('clearance', time.perf_counter() - start)
+
+    def _popDensity(self):
+        start = time.perf_counter()
+        popDensity = TreatedPatient._popDensity(self)
+        self.profile.addTime('density', time.perf_counter() - start)
+        return popDensity
+
+    def _reproduceViruses(self, popDensity, rng):
+        # The reproduction time is the whole phase minus the mutation time
+        # measured around each offspring's _childBits()
+        seconds = self.profile.seconds['mutation']
+        mutationTime = seconds[-1]
+        start = time.perf_counter()
+        numViruses = len(self.viruses)
+        TreatedPatient._reproduceViruses(self, popDensity, rng)
+        mutationTime = seconds[-1] - mutationTime
+        self.profile.addCount('births', len(self.viruses) - numViruses)
+        self.profile.addTime('reproduction', time.perf_counter() - start - mutationTime)
+
+    def _childBits(self, virus, rng):
+        start = time.perf_counter()
+        childBits = TreatedPatient._childBits(self, virus, rng)
+        self.profile.addTime('mutation', time.perf_counter() - start)
+        self.profile.addCount('mutations', (childBits ^ virus.resistBits).bit_count())
+        return childBits
+
+
+def profileSimulationWithDrug(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timelyPrescriptions={}, numTrials=1, timeSteps=100, seed=None):
+    """
+    Runs trials of simulationWithDrug with the object engine and profiles
+    them.
+
+    seed: seed of the trial streams, as for ps3b_parallel.runTrials
+
+    returns: a PhaseProfile of every step of every trial
+    """
+    profile = PhaseProfile()
+    for seedSequence in np.random.SeedSequence(seed).spawn(numTrials):
+        patient = makeTreatedPatient(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, 'object',
+                                     seedTrial(seedSequence))
+        patient = ProfiledTreatedPatient.fromPatient(patient, profile)
+        for timeStep in range(timeSteps):
+            prescribe(patient, timelyPrescriptions, timeStep)
+            patient.update()
+            patient.getResistPop(patient.getPrescriptions())
+    return profile
+
+
+
+if __name__ == '__main__':
+    print(profileSimulationWithDrug(100, 1000, 0.1, 0.05, ['guttagonol', 'srinol'], 0.005,
+                                    {150: 'guttagonol', 300: 'srinol'}, numTrials=5, timeSteps=400, seed=0).formatReport())
@@ -0,0 +1,151 @@
+# Block random number source for the object engine
+"""
+The object engine draws its random numbers from the rng of each patient,
+any object with a random() method returning uniform floats in [0, 1). By
+default that is the random module. BlockRandom is a per-trial alternative
+backed by a numpy bit generator (PCG64 or Philox): it fills blocks of floats
+with one vectorized call and hands them out one by one, so trials have
+independent, seedable streams that do not share state with the random module
+or with each other, and a trial gives the same results bit for bit whatever
+else runs in the process.
+"""
+
+import itertools
+
+import numpy as np
+
+
+
+BIT_GENERATORS = {
+    'PCG64'   : np.random.PCG64,
+    'PCG64DXSM': np.random.PCG64DXSM,
+    'Philox'  : np.random.Philox,
+    'SFC64'   : np.random.SFC64,
+}
+
+
+def _jsonState(value):
+    """
+    Converts a bit generator state to JSON-compatible values (numpy arrays
+    become {'array': list of integers, 'dtype': name}).
+    """
+    if isinstance(value, dict):
+        return {key: _jsonState(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return {'array': value.tolist(), 'dtype': value.dtype.name}
+    return value
+
+
+def _numpyState(value):
+    """
+    Inverse of _jsonState.
+    """
+    if isinstance(value, dict):
+        if set(value) == {'array', 'dtype'}:
+            return np.array(value['array'], dtype=value['dtype'])
+        return {key: _numpyState(item) for key, item in value.items()}
+    return value
+
+
+class BlockRandom(object):
+    """
+    Source of uniform floats pre-generated in blocks by a numpy Generator.
+
+    The state of a BlockRandom is the state of its bit generator before the
+    current block was generated plus the number of floats taken from that
+    block; getState() returns it as JSON-compatible values, and pickling and
+    checkpoints use it to continue the stream exactly.
+    """
+
+    def __init__(self, seed=None, bitGenerator='PCG64', blockSize=4096):
+        """
+        seed: a numpy Generator to draw from, or a seed (an integer or a
+        SeedSequence) for a new one
+
+        bitGenerator: name of the bit generator of a new Generator, one of
+        BIT_GENERATORS
+
+        blockSize: number of floats generated at once (an integer)
+        """
+        if isinstance(seed, np.random.Generator):
+            self.generator = seed
+        else:
+            if bitGenerator not in BIT_GENERATORS:
+                raise ValueError(f'Unknown bit generator: {bitGenerator!r}')
+            self.generator = np.random.Generator(BIT_GENERATORS[bitGenerator](seed))
+        self.blockSize = blockSize
+        self._start(None, 0)
+
+    def _start(self, blockState, position):
+        """
+        Sets up random(): with blockState None the first block is generated
+        on the first draw, otherwise the block generated from blockState is
+        regenerated and its first position floats are skipped.
+        """
+        self.blockState = blockState
+        self.block = []
+        self.blockFloats = iter(self.block)
+        if blockState is not None:
+            self.generator.bit_generator.state = blockState
+            self._nextBlock()
+            for i in range(position):
+                next(self.blockFloats)
+
+        # random() is the __next__ of an endless chain of blocks, so a draw
+        # is a single C call and refills happen inside the chain. The chain
+        # iterates over the very iterator kept in blockFloats, whose length
+        # hint tells how far into the block the stream is.
+        blocks = itertools.chain([self.blockFloats], iter(self._nextBlock, None))
+        self.random = itertools.chain.from_iterable(blocks).__next__
+
+    def _nextBlock(self):
+        """
+        Generates the next block and returns the iterator over it.
+        """
+        self.blockState = self.generator.bit_generator.state
+        self.block = self.generator.random(self.blockSize).tolist()
+        self.blockFloats = iter(self.block)
+        return self.blockFloats
+
+    def getState(self):
+        """
+        Returns the state of the stream as JSON-compatible values.
+        """
+        return {
+            'blockSize'  : self.blockSize,
+            'blockState' : _jsonState(self.blockState),
+            'position'   : len(self.block) - self.blockFloats.__length_hint__(),
+            'state'      : _jsonState(self.generator.bit_generator.state),
+        }
+
+    def setState(self, state):
+        """
+        Restores a state returned by getState().
+        """
+        self.blockSize = state['blockSize']
+        generatorState = _numpyState(state['state'])
+        if type(self.generator.bit_generator).__name__ != generatorState['bit_generator']:
+            self.generator = np.random.Generator(BIT_GENERATORS[generatorState['bit_generator']]())
+        self.generator.bit_generator.state = generatorState
+        if state['blockState'] is not None:
+            self._start(_numpyState(state['blockState']), state['position'])
+        else:
+            self._start(None, 0)
+
+    @classmethod
+    def fromState(cls, state):
+        """
+        Returns a new BlockRandom continuing the stream of a state returned by
+        getState().
+        """
+        rng = cls.__new__(cls)
+        rng.generator = np.random.Generator(BIT_GENERATORS[state['state']['bit_generator']]())
+        rng.setState(state)
+        return rng
+
+    def __getstate__(self):
+        return self.getState()
+
+    def __setstate__(self, state):
+        self.generator = np.random.Generator(BIT_GENERATORS[state['state']['bit_generator']]())
+        self.setState(state)
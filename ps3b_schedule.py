@@ -0,0 +1,186 @@
+# Search for drug schedules that minimize the resistant population
+"""
+Ranks candidate timelyPrescriptions schedules of simulationWithDrug by the
+average resistant population they leave at the end of the simulation.
+Evaluating many schedules is made cheap in three ways:
+
+- shared prefixes: the candidates of a trial are simulated as a tree. Up to
+  the first time step where two candidates prescribe differently they are the
+  same simulation, so it runs once and is forked (TreatedPatient.fork) where
+  the schedules diverge.
+
+- common random numbers: the random stream of a trial restarts at every
+  decision time (a time step where some candidate prescribes a drug) from a
+  seed that only depends on the trial and the decision time. All candidates
+  then see the same random numbers in trial i, and differences between their
+  results come from the schedules rather than from the noise.
+
+- successive halving: every candidate is first evaluated on a few trials;
+  the better 1/eta of them are kept and evaluated on eta times as many
+  trials, and so on until one candidate is left or maxTrials is reached.
+"""
+
+import itertools
+
+import numpy as np
+
+from ps3b import makeTreatedPatient
+from ps3b_rng import BlockRandom
+
+
+
+def candidateSchedules(drugs, times, allowSkip=False):
+    """
+    Returns every schedule that prescribes each drug once, at one of times.
+
+    drugs: the drug names (strings)
+
+    times: the time steps a drug can be prescribed at (integers)
+
+    allowSkip: whether schedules may also leave a drug out
+
+    returns: a list of timelyPrescriptions dictionaries {timeStep : list of
+    drug names}
+    """
+    options = list(times) + ([None] if allowSkip else [])
+    schedules = []
+    for choice in itertools.product(options, repeat=len(drugs)):
+        schedule = {}
+        for drug, timeStep in zip(drugs, choice):
+            if timeStep is not None:
+                schedule.setdefault(timeStep, []).append(drug)
+        schedules.append(schedule)
+    return schedules
+
+
+def _normalize(schedule):
+    """
+    Returns schedule as {timeStep : sorted tuple of drug names}.
+    """
+    return {int(timeStep): tuple(sorted([drugs] if isinstance(drugs, str) else drugs))
+            for timeStep, drugs in schedule.items()}
+
+
+def _trialTree(params, schedules, candidates, trialSeed, decisionTimes):
+    """
+    Simulates one trial of every candidate as a tree of forked patients.
+
+    params: (startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb,
+    timeSteps)
+
+    schedules: normalized schedules of all candidates
+
+    candidates: indices of the candidates to simulate
+
+    trialSeed: SeedSequence of the trial; segment k of the trial draws from
+    its k-th child
+
+    decisionTimes: sorted time steps where the random stream restarts,
+    starting with 0
+
+    returns: {candidate index : final resistant population}
+    """
+    startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timeSteps = params
+    boundaries = decisionTimes + [timeSteps]
+    segmentSeeds = trialSeed.spawn(len(decisionTimes))
+    results = {}
+
+    def simulate(patient, segment, group):
+        start, end = boundaries[segment], boundaries[segment + 1]
+        branches = {}
+        for candidate in group:
+            branches.setdefault(schedules[candidate].get(start, ()), []).append(candidate)
+        for number, (newDrugs, branch) in enumerate(branches.items()):
+            # The last branch continues with the patient itself
+            child = patient if number == len(branches) - 1 else patient.fork()
+            for drug in newDrugs:
+                child.addPrescription(drug)
+            child.rng = BlockRandom(segmentSeeds[segment])
+            for timeStep in range(start, end):
+                child.update()
+            if segment + 1 < len(decisionTimes):
+                simulate(child, segment + 1, branch)
+            else:
+                resistPop = child.getResistPop(child.getPrescriptions())
+                for candidate in branch:
+                    results[candidate] = resistPop
+
+    simulate(makeTreatedPatient(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb), 0, candidates)
+    return results
+
+
+def optimizeSchedule(startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, schedules, timeSteps=300, minTrials=4, maxTrials=64, eta=2, seed=None):
+    """
+    Ranks drug schedules by the average final resistant population (the
+    particles resistant to every drug prescribed by then) with successive
+    halving.
+
+    schedules: the candidate timelyPrescriptions dictionaries, e.g. from
+    candidateSchedules
+
+    timeSteps: length of each simulation (an integer)
+
+    minTrials: trials per candidate in the first round (an integer)
+
+    maxTrials: most trials a candidate is evaluated on (an integer)
+
+    eta: factor by which the number of candidates shrinks and the number of
+    trials grows each round (an integer, at least 2)
+
+    seed: entropy of the trial streams (an integer, or None for fresh
+    entropy)
+
+    returns: a list of dictionaries, best first, with the 'schedule', the
+    'meanResistPop' and its 'stdError' over the 'numTrials' trials the
+    schedule was evaluated on, and the 'round' it reached (0 for the first).
+    Candidates that reached a later round come first, then by meanResistPop.
+    """
+    if eta < 2:
+        raise ValueError('eta must be at least 2')
+    normalized = [_normalize(schedule) for schedule in schedules]
+    for schedule in normalized:
+        if any(timeStep < 0 or timeStep >= timeSteps for timeStep in schedule):
+            raise ValueError(f'Prescription time outside of the simulation: {schedule}')
+    decisionTimes = sorted({0} | {timeStep for schedule in normalized for timeStep in schedule})
+    params = (startPop, maxPop, maxBirthProb, clearProb, drugs, mutProb, timeSteps)
+    rootSeed = np.random.SeedSequence(seed)
+    trialSeeds = rootSeed.spawn(maxTrials)
+
+    scores = [[] for schedule in schedules]
+    rounds = [0] * len(schedules)
+    alive = list(range(len(schedules)))
+    numTrials = min(minTrials, maxTrials)
+    roundNumber = 0
+    while True:
+        for trial in range(len(scores[alive[0]]), numTrials):
+            for candidate, resistPop in _trialTree(params, normalized, alive, trialSeeds[trial], decisionTimes).items():
+                scores[candidate].append(resistPop)
+        for candidate in alive:
+            rounds[candidate] = roundNumber
+        if len(alive) == 1 or numTrials == maxTrials:
+            break
+        alive.sort(key=lambda candidate: np.mean(scores[candidate]))
+        alive = alive[:max(1, len(alive) // eta)]
+        numTrials = min(numTrials * eta, maxTrials)
+        roundNumber += 1
+
+    ranking = []
+    for candidate, schedule in enumerate(schedules):
+        values = np.array(scores[candidate], dtype=np.float64)
+        ranking.append({
+            'schedule'      : {timeStep: list(drugs) for timeStep, drugs in sorted(normalized[candidate].items())},
+            'meanResistPop' : float(values.mean()),
+            'stdError'      : float(values.std(ddof=1) / np.sqrt(len(values))) if len(values) > 1 else float('inf'),
+            'numTrials'     : len(values),
+            'round'         : rounds[candidate],
+        })
+    ranking.sort(key=lambda entry: (-entry['round'], entry['meanResistPop']))
+    return ranking
+
+
+
+if __name__ == '__main__':
+    schedules = candidateSchedules(['guttagonol', 'srinol'], [50, 100, 150, 200])
+    for entry in optimizeSchedule(100, 1000, 0.1, 0.05, ['guttagonol', 'srinol'], 0.005, schedules, timeSteps=300,
+                                  seed=0)[:5]:
+        print(f'{entry["meanResistPop"]:8.1f} +- {entry["stdError"]:6.1f}  ({entry["numTrials"]} trials)  {entry["schedule"]}')
@@ -0,0 +1,50 @@
+# Checks of the drug schedule search, run with pytest
+"""
+Checks of ps3b_schedule.optimizeSchedule: the successive halving rounds keep
+the best 1/eta of the candidates on the same trials, the ranking puts later
+rounds first and then the lowest resistant populations, and the result of a
+candidate simulated in the tree does not depend on the other candidates.
+"""
+
+from ps3b_schedule import candidateSchedules, optimizeSchedule
+
+
+
+PARAMS = (100, 1000, 0.1, 0.05, ['A', 'B'], 0.005)
+TIME_STEPS = 150
+SCHEDULES = candidateSchedules(['A', 'B'], [50, 100], allowSkip=True)
+
+
+def testRoundsAndRanking():
+    ranking = optimizeSchedule(*PARAMS, SCHEDULES, TIME_STEPS, minTrials=2, maxTrials=8, eta=2, seed=1)
+    assert len(ranking) == len(SCHEDULES) == 9
+    assert sorted(entry['round'] for entry in ranking) == [0, 0, 0, 0, 0, 1, 1, 2, 2]
+    for entry in ranking:
+        assert entry['numTrials'] == 2 * 2 ** entry['round']
+    keys = [(-entry['round'], entry['meanResistPop']) for entry in ranking]
+    assert keys == sorted(keys)
+    # Without any drug every particle counts as resistant
+    assert ranking[-1]['schedule'] == {}
+
+
+def testPruningKeepsTheBestOnTheSameTrials():
+    full = optimizeSchedule(*PARAMS, SCHEDULES, TIME_STEPS, minTrials=2, maxTrials=8, eta=2, seed=1)
+    # The first round alone: every candidate on the same first two trials
+    firstRound = optimizeSchedule(*PARAMS, SCHEDULES, TIME_STEPS, minTrials=2, maxTrials=2, eta=2, seed=1)
+    assert all(entry['round'] == 0 and entry['numTrials'] == 2 for entry in firstRound)
+
+    kept = [entry['schedule'] for entry in full if entry['round'] > 0]
+    assert sorted(map(str, kept)) == sorted(str(entry['schedule']) for entry in firstRound[:len(kept)])
+    dropped = [entry for entry in full if entry['round'] == 0]
+    for entry in dropped:
+        assert entry in firstRound
+
+
+def testTreeDoesNotDependOnTheOtherCandidates():
+    together = optimizeSchedule(*PARAMS, SCHEDULES, TIME_STEPS, minTrials=3, maxTrials=3, seed=2)
+    # Paired with a schedule that has the same decision times, so that the
+    # random streams restart at the same time steps
+    other = {50: ['A'], 100: ['B']}
+    for entry in together:
+        pair = optimizeSchedule(*PARAMS, [entry['schedule'], other], TIME_STEPS, minTrials=3, maxTrials=3, seed=2)
+        assert pair[0 if pair[0]['schedule'] == entry['schedule'] else 1]['meanResistPop'] == entry['meanResistPop']
@@ -0,0 +1,211 @@
+# Parameter sweeps over simulationWithDrug with an on-disk result cache
+"""
+Runs simulationWithDrug for every point of a parameter grid and keeps the
+averaged curves in an on-disk cache. A cache entry is addressed by a hash of
+the canonical form of the simulation parameters (seed included), so a point
+that was already simulated with the same parameters and seed is read back
+from disk instead of being simulated again. The hash also covers
+CACHE_VERSION, so entries computed by code that gave other seeded results are
+never read back. The cache evicts the least recently used entries once it
+grows beyond a size limit.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from ps3b_parallel import parallelSimulationWithDrug
+
+
+
+# Version of the simulation code in the cache keys. Bump it whenever a change
+# makes a seeded simulation give different curves, e.g. a different order or
+# number of random draws in an engine.
+CACHE_VERSION = 1
+
+# Parameters of simulationWithDrug, with their default values
+DEFAULT_PARAMS = {
+    'startPop'            : 100,
+    'maxPop'              : 1000,
+    'maxBirthProb'        : 0.1,
+    'clearProb'           : 0.05,
+    'drugs'               : [],
+    'mutProb'             : 0.005,
+    'timelyPrescriptions' : {},
+    'numTrials'           : 10,
+    'timeSteps'           : 100,
+    'engine'              : 'object',
+    'seed'                : 0,
+}
+
+
+def canonicalParams(params):
+    """
+    Returns params completed with DEFAULT_PARAMS and normalized so that
+    equivalent parameter sets compare equal: every prescription becomes a list
+    of drug names and the prescription time steps become integers.
+    """
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f'Unknown simulation parameters: {sorted(unknown)}')
+    canonical = dict(DEFAULT_PARAMS)
+    canonical.update(params)
+    canonical['drugs'] = list(canonical['drugs'])
+    canonical['timelyPrescriptions'] = {
+        int(timeStep): [drugs] if isinstance(drugs, str) else list(drugs)
+        for timeStep, drugs in canonical['timelyPrescriptions'].items()
+    }
+    return canonical
+
+
+def paramsKey(params):
+    """
+    Returns the cache key of a parameter set: the SHA-256 hex digest of the
+    canonical JSON form of the parameters and CACHE_VERSION.
+    """
+    canonical = canonicalParams(params)
+    canonical['timelyPrescriptions'] = sorted(canonical['timelyPrescriptions'].items())
+    text = json.dumps({'version': CACHE_VERSION, 'params': canonical}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of averaged simulation curves, one .npz file per
+    parameter set, with least recently used eviction.
+    """
+
+    def __init__(self, directory='.ps3b_cache', maxBytes=256 * 2**20):
+        """
+        directory: where the cache files are kept (created if missing)
+
+        maxBytes: size the cache is trimmed down to after each insertion (an
+        integer)
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the curves stored under key (a tuple of numpy arrays), or None
+        if there are none. A hit marks the entry as recently used.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                curves = tuple(data[name] for name in sorted(data.files))
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return curves
+
+    def put(self, key, curves):
+        """
+        Stores curves (a tuple of arrays) under key, then evicts the least
+        recently used entries until the cache fits in maxBytes.
+        """
+        handle, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            np.savez(file, **{f'curve{i}': np.asarray(curve) for i, curve in enumerate(curves)})
+        os.replace(tmpPath, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        maxBytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entrySize for mtime, entrySize, path in entries)
+        for mtime, entrySize, path in entries:
+            if size <= self.maxBytes:
+                break
+            os.remove(path)
+            size -= entrySize
+
+    def clear(self):
+        """
+        Removes every entry of the cache.
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+
+
+def cachedSimulationWithDrug(cache, workers=None, **params):
+    """
+    Returns the averaged curves of simulationWithDrug for params, read from
+    cache if this parameter set was simulated before, simulated on a process
+    pool and stored in cache otherwise. Without a seed (seed=None) the run is
+    not reproducible and the cache is bypassed.
+
+    params: keyword parameters of simulationWithDrug plus seed, see
+    DEFAULT_PARAMS
+
+    returns: a tuple (average total population, average resistant population)
+    of numpy arrays, one value per time step
+    """
+    params = canonicalParams(params)
+    key = None if params['seed'] is None else paramsKey(params)
+    if key is not None:
+        curves = cache.get(key)
+        if curves is not None:
+            return curves
+
+    curves = tuple(np.array(curve) for curve in parallelSimulationWithDrug(workers=workers, **params))
+    if key is not None:
+        cache.put(key, curves)
+    return curves
+
+
+def expandGrid(grid, **fixed):
+    """
+    Returns the list of parameter sets of a grid: one dictionary per
+    combination of the values in grid, completed with the fixed parameters.
+
+    grid: {parameter name : list of values to try}
+    """
+    names = list(grid)
+    points = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        point = dict(fixed)
+        point.update(zip(names, values))
+        points.append(point)
+    return points
+
+
+def sweep(grid, cache=None, workers=None, **fixed):
+    """
+    Runs simulationWithDrug on every point of a parameter grid.
+
+    grid: {parameter name : list of values to try}, e.g. {'mutProb': [0.001,
+    0.005], 'numTrials': [10, 100]}
+
+    cache: a ResultCache (None for a ResultCache in the default directory)
+
+    workers: number of processes used per simulated point (None for one per
+    CPU)
+
+    fixed: parameters shared by all points
+
+    returns: a list of (parameters, (average total population, average
+    resistant population)) pairs, one per grid point in grid order
+    """
+    if cache is None:
+        cache = ResultCache()
+    return [(point, cachedSimulationWithDrug(cache, workers, **point)) for point in expandGrid(grid, **fixed)]
@@ -0,0 +1,57 @@
+# Checks of the parameter sweeps and their result cache, run with pytest
+"""
+Checks of ps3b_sweep: cached parameter sets are read back instead of being
+simulated again, the cache evicts its least recently used entries, and the
+cache keys change with CACHE_VERSION.
+"""
+
+import os
+
+import numpy as np
+
+import ps3b_sweep
+from ps3b_sweep import ResultCache, cachedSimulationWithDrug, paramsKey
+
+
+
+PARAMS = {'startPop': 20, 'maxPop': 200, 'drugs': ['A'], 'timelyPrescriptions': {10: 'A'}, 'numTrials': 2,
+          'timeSteps': 20, 'seed': 3}
+
+
+def testCacheHit(tmp_path, monkeypatch):
+    cache = ResultCache(tmp_path)
+    curves = cachedSimulationWithDrug(cache, workers=1, **PARAMS)
+    assert len(curves[0]) == PARAMS['timeSteps']
+
+    def simulate(**params):
+        raise AssertionError('cached parameters simulated again')
+    monkeypatch.setattr(ps3b_sweep, 'parallelSimulationWithDrug', simulate)
+    # Equivalent parameters have the same key
+    cached = cachedSimulationWithDrug(cache, workers=1, **dict(PARAMS, timelyPrescriptions={'10': ['A']}))
+    for curve, cachedCurve in zip(curves, cached):
+        assert np.array_equal(curve, cachedCurve)
+
+
+def testLeastRecentlyUsedEviction(tmp_path):
+    curves = (np.zeros(1000), np.zeros(1000))
+    cache = ResultCache(tmp_path)
+    cache.put('a', curves)
+    entrySize = os.path.getsize(cache._path('a'))
+    cache.maxBytes = 2 * entrySize
+    cache.put('b', curves)
+    os.utime(cache._path('a'), (1, 1))
+    os.utime(cache._path('b'), (2, 2))
+
+    # Reading 'a' makes 'b' the least recently used entry
+    assert cache.get('a') is not None
+    cache.put('c', curves)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def testKeyCoversCacheVersion(monkeypatch):
+    key = paramsKey(PARAMS)
+    assert paramsKey(dict(PARAMS, timelyPrescriptions={'10': ['A']})) == key
+    assert paramsKey(dict(PARAMS, seed=4)) != key
+    monkeypatch.setattr(ps3b_sweep, 'CACHE_VERSION', ps3b_sweep.CACHE_VERSION + 1)
+    assert paramsKey(PARAMS) != key
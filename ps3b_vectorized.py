@@ -0,0 +1,271 @@
+# Array-backed engine for the virus population simulation
+"""
+Vectorized versions of Patient and TreatedPatient. Instead of keeping one
+python object per virus particle, the population is stored as NumPy arrays:
+per-particle birth, clearance and mutation probabilities plus a bit-packed
+matrix of drug resistances (one row per particle, one bit per drug). Clearance,
+birth and mutation of the whole population are each done with a single batched
+random draw, so one time step costs a handful of array operations no matter how
+many particles there are.
+"""
+
+import numpy as np
+
+from ps3b import SimpleVirus, ResistantVirus
+
+
+
+class ArrayPatient(object):
+    """
+    Array-backed equivalent of Patient. Viruses have no drug resistance.
+    """
+
+    def __init__(self, birthProbs, clearProbs, maxPop, rng=None):
+        """
+        Initialization function, saves the population arrays and maxPop.
+
+        birthProbs: maximum reproduction probability of each particle (an array
+        of floats between 0-1)
+
+        clearProbs: clearance probability of each particle (an array of floats
+        between 0-1, same length as birthProbs)
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: a numpy Generator or a seed for one (optional)
+        """
+        self.birthProbs = np.asarray(birthProbs, dtype=np.float64)
+        self.clearProbs = np.asarray(clearProbs, dtype=np.float64)
+        self.maxPop = maxPop
+        self.rng = np.random.default_rng(rng)
+
+    @classmethod
+    def fromViruses(cls, viruses, maxPop, rng=None):
+        """
+        Builds an ArrayPatient from a list of SimpleVirus instances.
+        """
+        birthProbs = [virus.getMaxBirthProb() for virus in viruses]
+        clearProbs = [virus.getClearProb() for virus in viruses]
+        return cls(birthProbs, clearProbs, maxPop, rng)
+
+    def getViruses(self):
+        """
+        Returns the viruses in this patient as a list of SimpleVirus instances.
+        This builds a new object per particle and is only meant for inspection.
+        """
+        return [SimpleVirus(birthProb, clearProb)
+                for birthProb, clearProb in zip(self.birthProbs.tolist(), self.clearProbs.tolist())]
+
+    def getMaxPop(self):
+        """
+        Returns the max population.
+        """
+        return self.maxPop
+
+    def getTotalPop(self):
+        """
+        Gets the size of the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return len(self.birthProbs)
+
+    def _keep(self, survivors):
+        """
+        Drops every particle whose entry in the boolean array survivors is False.
+        """
+        self.birthProbs = self.birthProbs[survivors]
+        self.clearProbs = self.clearProbs[survivors]
+
+    def _append(self, parents):
+        """
+        Appends one offspring for every particle whose entry in the boolean
+        array parents is True.
+        """
+        self.birthProbs = np.concatenate((self.birthProbs, self.birthProbs[parents]))
+        self.clearProbs = np.concatenate((self.clearProbs, self.clearProbs[parents]))
+
+    def _canReproduce(self):
+        """
+        Returns a boolean array telling which particles are allowed to reproduce
+        at all in this time step.
+        """
+        return np.ones(self.getTotalPop(), dtype=bool)
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as Patient.update(): clearance, then
+        population density, then reproduction.
+
+        returns: The total virus population at the end of the update (an
+        integer)
+        """
+        self._keep(self.rng.random(self.getTotalPop()) >= self.clearProbs)
+
+        popDensity = self.getTotalPop() / self.getMaxPop()
+
+        birthProbs = self.birthProbs * (1 - popDensity)
+        parents = self._canReproduce() & (self.rng.random(self.getTotalPop()) < birthProbs)
+        self._append(parents)
+
+        return self.getTotalPop()
+
+
+
+class ArrayTreatedPatient(ArrayPatient):
+    """
+    Array-backed equivalent of TreatedPatient. Resistances of particle i are
+    stored as the bits of row i in resistBits, the j-th bit corresponding to
+    drugs[j].
+    """
+
+    def __init__(self, birthProbs, clearProbs, resistances, mutProbs, drugs, maxPop, rng=None):
+        """
+        Initialization function, saves the population arrays and maxPop. Also
+        initializes the list of drugs being administered (which initially
+        includes no drugs).
+
+        birthProbs, clearProbs: as in ArrayPatient
+
+        resistances: resistance of each particle to each drug (a boolean array
+        of shape (population, len(drugs)))
+
+        mutProbs: mutation probability of each particle (an array of floats)
+
+        drugs: the drug names (strings), giving the column order of resistances
+
+        maxPop: the maximum virus population for this patient (an integer)
+
+        rng: a numpy Generator or a seed for one (optional)
+        """
+        ArrayPatient.__init__(self, birthProbs, clearProbs, maxPop, rng)
+        self.mutProbs = np.asarray(mutProbs, dtype=np.float64)
+        self.drugs = list(drugs)
+        resistances = np.asarray(resistances, dtype=bool).reshape(len(self.birthProbs), len(self.drugs))
+        self.resistBits = np.packbits(resistances, axis=1)
+        self.prescriptions = []
+
+    @classmethod
+    def fromViruses(cls, viruses, maxPop, rng=None):
+        """
+        Builds an ArrayTreatedPatient from a list of ResistantVirus instances.
+        """
+        drugs = []
+        for virus in viruses:
+            for drug in virus.getResistances():
+                if drug not in drugs:
+                    drugs.append(drug)
+        birthProbs = [virus.getMaxBirthProb() for virus in viruses]
+        clearProbs = [virus.getClearProb() for virus in viruses]
+        mutProbs = [virus.getMutProb() for virus in viruses]
+        resistances = [[virus.isResistantTo(drug) for drug in drugs] for virus in viruses]
+        return cls(birthProbs, clearProbs, resistances, mutProbs, drugs, maxPop, rng)
+
+    @classmethod
+    def fromParameters(cls, startPop, maxPop, maxBirthProb, clearProb, resistances, mutProb, rng=None):
+        """
+        Builds an ArrayTreatedPatient holding startPop identical particles,
+        the array equivalent of startPop ResistantVirus(maxBirthProb,
+        clearProb, resistances, mutProb) instances.
+
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of the particles' resistance (either True or False) to each drug.
+        """
+        drugs = list(resistances)
+        row = [bool(resistances[drug]) for drug in drugs]
+        return cls(np.full(startPop, maxBirthProb), np.full(startPop, clearProb),
+                   np.tile(np.array(row, dtype=bool), (startPop, 1)),
+                   np.full(startPop, mutProb), drugs, maxPop, rng)
+
+    def getViruses(self):
+        """
+        Returns the viruses in this patient as a list of ResistantVirus
+        instances. This builds a new object per particle and is only meant for
+        inspection.
+        """
+        resistances = np.unpackbits(self.resistBits, axis=1, count=len(self.drugs)).astype(bool)
+        return [ResistantVirus(birthProb, clearProb, dict(zip(self.drugs, row)), mutProb)
+                for birthProb, clearProb, row, mutProb
+                in zip(self.birthProbs.tolist(), self.clearProbs.tolist(), resistances.tolist(), self.mutProbs.tolist())]
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. If the newDrug is already prescribed
+        to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer to the patient (a string).
+        """
+        if newDrug not in self.prescriptions:
+            self.prescriptions.append(newDrug)
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+        """
+        return self.prescriptions[:]
+
+    def _drugMask(self, drugs):
+        """
+        Returns the packed bitmask (a uint8 array) with the bits of drugs set,
+        or None if some drug is not tracked by this patient (no particle is
+        resistant to an unknown drug).
+        """
+        row = np.zeros(len(self.drugs), dtype=bool)
+        for drug in drugs:
+            if drug not in self.drugs:
+                return None
+            row[self.drugs.index(drug)] = True
+        return np.packbits(row)
+
+    def _resistantTo(self, drugs):
+        """
+        Returns a boolean array telling which particles are resistant to all
+        the drugs in the list drugs.
+        """
+        mask = self._drugMask(drugs)
+        if mask is None:
+            return np.zeros(self.getTotalPop(), dtype=bool)
+        return np.all((self.resistBits & mask) == mask, axis=1)
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
+
+        returns: The population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        return int(np.count_nonzero(self._resistantTo(drugResist)))
+
+    def getGenotypeCounts(self):
+        """
+        Returns the number of particles of each genotype, a dictionary mapping
+        resistance bitmasks (bit j set for resistance to drugs[j]) onto counts.
+        """
+        resistances = np.unpackbits(self.resistBits, axis=1, count=len(self.drugs))
+        masks = resistances.astype(np.int64) @ (1 << np.arange(len(self.drugs), dtype=np.int64))
+        genotypes, counts = np.unique(masks, return_counts=True)
+        return dict(zip(genotypes.tolist(), counts.tolist()))
+
+    def _keep(self, survivors):
+        ArrayPatient._keep(self, survivors)
+        self.mutProbs = self.mutProbs[survivors]
+        self.resistBits = self.resistBits[survivors]
+
+    def _append(self, parents):
+        # Each offspring flips each of its parent's resistance bits with the
+        # parent's mutProb, drawn for all offspring and drugs at once
+        childMutProbs = self.mutProbs[parents]
+        childBits = self.resistBits[parents]
+        flips = self.rng.random((len(childMutProbs), len(self.drugs))) < childMutProbs[:, None]
+        childBits = childBits ^ np.packbits(flips, axis=1)
+
+        ArrayPatient._append(self, parents)
+        self.mutProbs = np.concatenate((self.mutProbs, childMutProbs))
+        self.resistBits = np.concatenate((self.resistBits, childBits))
+
+    def _canReproduce(self):
+        return self._resistantTo(self.prescriptions)